@@ -6,3 +6,7 @@ from . import files
 from . import batch
 from . import vis
 from . import pbar
+from . import benchmark
+from . import writer
+from . import medsreaders
+from . import pack
@@ -94,6 +94,7 @@ class BatchBase(dict):
 
         for isplit,fof_split in enumerate(fof_splits):
             logger.info('%s %s' % (isplit,fof_split))
+            self._log_split_cost(fof_split)
             self._write_split(isplit, fof_split)
 
     def _make_dirs(self):
@@ -161,6 +162,26 @@ class BatchBase(dict):
 
         os.system('chmod 755 %s' % fname)
 
+    def _log_split_cost(self, fof_split):
+        """
+        log the predicted cost of the split, relative to the mean,
+        if the fof_stats are available
+        """
+        if self.fof_stats is None:
+            return
+
+        start, end = fof_split
+        cost = self.fof_stats['cost']
+        split_cost = cost[start:end+1].sum()
+
+        nsplit = cost.size/float(self['chunksize'])
+        mean_cost = cost.sum()/nsplit
+
+        if mean_cost > 0:
+            logger.info('    predicted cost: %g (%.2f times mean)' % (
+                split_cost, split_cost/mean_cost,
+            ))
+
     def _get_seed(self):
         return self.rng.randint(0,2**31)
 
@@ -174,8 +195,9 @@ class BatchBase(dict):
 
     def _load_fofs(self):
         #nbrs,fofs=files.load_fofs(self.args.fofs)
-        nbrs,fofs=files.load_fofs(self['fof_file'])
+        fofs,=files.load_fofs(self['fof_file'], extensions=['fofs'])
         self.fofs=fofs
+        self.fof_stats=files.load_fof_stats(self['fof_file'])
 
 
     def _set_rng(self):
@@ -223,6 +245,9 @@ class WQBatch(ShellBatch):
                     with fitsio.FITS(output_file) as fits:
                         if ('model_fits' in fits and 'epochs_data' in fits):
                             ok=True
+                        elif len(fits) == 1:
+                            # no groups in the split were owned
+                            ok=True
                         else:
                             print('extensions missing')
                             ok=False
@@ -270,6 +295,7 @@ class CondorBatch(BatchBase):
                 fobj = self._open_condor_script(icondor)
                 icondor += 1
 
+            self._log_split_cost(fof_split)
             self._write_split(fobj, isplit, fof_split)
 
             njobs += 1
@@ -405,6 +431,7 @@ fitcosmos \
     --fofs=$fofs \
     --start=$start \
     --end=$end \
+    --resume \
     %(model_pars)s \
     %(offsets)s \
     $meds &> $tmplog
@@ -481,6 +508,7 @@ fitcosmos \
     --fofs=$fofs \
     --start=$start \
     --end=$end \
+    --resume \
     $meds &> $tmplog
 
 mv -vf $tmplog $logfile
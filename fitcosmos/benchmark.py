@@ -0,0 +1,308 @@
+"""
+scaling benchmarks for the FoF finder
+
+Synthetic catalogs are generated with the same columns as the MEDS
+object_data used by fofs.get_fofs, so different versions of the code
+or different backends can be compared at production sizes.
+"""
+import time
+import tracemalloc
+import numpy as np
+import fitsio
+
+from . import fofs
+
+DEFAULT_SIZES = [10**3, 10**4, 10**5, 10**6, 10**7]
+DEFAULT_BACKENDS = ['grid', 'grid-numba', 'tiled', 'brute']
+
+BENCH_FOF_CONF = {
+    'method':'radius',
+    'radius_column':'iso_radius_arcsec',
+    'radius_mult':1.0,
+    'padding_arcsec':1.5,
+    'min_radius_arcsec':0.5,
+    'max_radius_arcsec':5.0,
+}
+
+def make_catalog(nobj,
+                 rng,
+                 density=50.0,
+                 cluster_frac=0.3,
+                 cluster_size=20,
+                 cluster_sigma=3.0,
+                 dec0=2.0):
+    """
+    make a synthetic catalog with the columns used by the FoF finder
+
+    A fraction of the objects are placed in gaussian clusters around
+    random centers, the rest are uniform over a square patch.  The
+    radii are log-normal, with a distribution similar to iso_radius_arcsec
+    in DES coadds.
+
+    parameters
+    ----------
+    nobj: int
+        Number of objects
+    rng: np.random.RandomState
+        The random number generator
+    density: float, optional
+        Objects per square arcmin, default 50
+    cluster_frac: float, optional
+        Fraction of objects in clusters, default 0.3
+    cluster_size: int, optional
+        Mean number of objects in a cluster, default 20
+    cluster_sigma: float, optional
+        Size of the clusters in arcsec, default 3
+    dec0: float, optional
+        Dec of the center of the patch in degrees, default 2
+
+    returns
+    -------
+    cat: array
+        The catalog
+    """
+    area = nobj/density
+    side = np.sqrt(area)/60.0
+    cosdec = np.cos(np.radians(dec0))
+
+    cat = np.zeros(
+        nobj,
+        dtype=[
+            ('id','i8'),
+            ('number','i8'),
+            ('ra','f8'),
+            ('dec','f8'),
+            ('iso_radius_arcsec','f4'),
+            ('orig_start_row','i4',(1,)),
+            ('orig_start_col','i4',(1,)),
+            ('ncutout','i4'),
+            ('box_size','i4'),
+        ],
+    )
+    cat['id'] = np.arange(nobj)
+    cat['number'] = np.arange(1, nobj+1)
+
+    x = rng.uniform(size=nobj)*side
+    y = rng.uniform(size=nobj)*side
+
+    ncl = int(nobj*cluster_frac)
+    nclusters = max(ncl//cluster_size, 1)
+    icl = rng.randint(0, nclusters, size=ncl)
+    sigma = cluster_sigma/3600.0
+    x[:ncl] = x[icl] + rng.normal(scale=sigma, size=ncl)
+    y[:ncl] = y[icl] + rng.normal(scale=sigma, size=ncl)
+
+    cat['ra'] = 10.0 + x/cosdec
+    cat['dec'] = dec0 - side/2.0 + y
+
+    cat['iso_radius_arcsec'] = rng.lognormal(
+        mean=np.log(0.8),
+        sigma=0.5,
+        size=nobj,
+    )
+
+    cat['ncutout'] = 1 + rng.poisson(lam=8, size=nobj)
+    box_size = 2*np.ceil(cat['iso_radius_arcsec']*4/0.263).astype('i4') + 16
+    cat['box_size'] = box_size.clip(min=32, max=256)
+
+    # a few objects without a stamp
+    nbad = nobj//1000
+    cat['orig_start_row'][:nbad,0] = -9999
+    cat['orig_start_col'][:nbad,0] = -9999
+
+    # shuffle so the clusters are not first in the catalog
+    cat = cat[rng.permutation(nobj)]
+    cat['id'] = np.arange(nobj)
+    cat['number'] = np.arange(1, nobj+1)
+    return cat
+
+def run_backend(cat, backend, fof_conf=None, nproc=1, tile_size=300.0):
+    """
+    run get_fofs on the catalog with the specified backend
+
+    parameters
+    ----------
+    cat: array
+        As returned by make_catalog
+    backend: string
+        'grid', 'grid-numba', 'tiled' or 'brute'
+    fof_conf: dict, optional
+        Base fofs config, default BENCH_FOF_CONF
+    nproc: int, optional
+        Number of processes for the nbrs search
+    tile_size: float, optional
+        Tile size in arcsec for the 'tiled' backend
+
+    returns
+    -------
+    nbr_data, fofs, wall time, peak memory in bytes
+
+    The peak memory is from tracemalloc, which sees the numpy
+    allocations in this process but not those in pool workers or
+    inside numba kernels
+    """
+    if fof_conf is None:
+        fof_conf = BENCH_FOF_CONF
+
+    conf = {}
+    conf.update(fof_conf)
+    tsize = None
+
+    if backend == 'grid':
+        conf['nbrs_backend'] = 'grid'
+    elif backend == 'grid-numba':
+        conf['nbrs_backend'] = 'grid'
+        conf['engine'] = 'numba'
+    elif backend == 'tiled':
+        tsize = tile_size
+    elif backend == 'brute':
+        conf['nbrs_backend'] = 'brute'
+    else:
+        raise ValueError("bad backend '%s', should be one of "
+                         "%s" % (backend, DEFAULT_BACKENDS))
+
+    tracemalloc.start()
+    try:
+        tm0 = time.time()
+        nbr_data, fof_data = fofs.get_fofs(
+            cat,
+            conf,
+            nproc=nproc,
+            tile_size=tsize,
+        )
+        tm = time.time()-tm0
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return nbr_data, fof_data, tm, peak
+
+def get_group_stats(nbr_data, fof_data):
+    """
+    get the group size statistics
+    """
+    sizes = np.bincount(fof_data['fofid'])
+    nobj = fof_data.size
+    nlinks = (nbr_data['nbr_number'] > 0).sum()//2
+
+    return {
+        'nfofs':sizes.size,
+        'nlinks':nlinks,
+        'max_size':sizes.max(),
+        'mean_size':nobj/float(sizes.size),
+        'p99_size':np.percentile(sizes, 99),
+        'frac_grouped':sizes[sizes > 1].sum()/float(nobj),
+    }
+
+def get_output_dtype():
+    return [
+        ('backend','S12'),
+        ('nobj','i8'),
+        ('nproc','i4'),
+        ('time','f8'),
+        ('peak_mem','i8'),
+        ('nfofs','i8'),
+        ('nlinks','i8'),
+        ('max_size','i8'),
+        ('mean_size','f8'),
+        ('p99_size','f8'),
+        ('frac_grouped','f8'),
+    ]
+
+def run_benchmarks(sizes=None,
+                   backends=None,
+                   seed=None,
+                   nproc=1,
+                   max_brute_size=30000):
+    """
+    run the benchmarks over the requested sizes and backends
+
+    parameters
+    ----------
+    sizes: list, optional
+        Catalog sizes, default DEFAULT_SIZES
+    backends: list, optional
+        Backends to run, default DEFAULT_BACKENDS
+    seed: int, optional
+        Seed for the catalogs, the same catalog is used for each
+        backend at a given size
+    nproc: int, optional
+        Number of processes for the nbrs search
+    max_brute_size: int, optional
+        The brute force backend is quadratic, and is skipped for
+        larger catalogs.  Default 30000
+
+    The grid-numba backend is skipped if numba is not available, since
+    get_fofs would fall back to the numpy engine
+
+    returns
+    -------
+    output: array
+        One row per size and backend
+    """
+    if sizes is None:
+        sizes = DEFAULT_SIZES
+    if backends is None:
+        backends = DEFAULT_BACKENDS
+
+    rng = np.random.RandomState(seed)
+
+    if 'grid-numba' in backends:
+        if fofs._get_engine({'engine':'numba'}) != 'numba':
+            print('skipping grid-numba: numba is not available')
+            backends = [b for b in backends if b != 'grid-numba']
+        else:
+            # compile the kernels so the compile time is not included
+            run_backend(make_catalog(100, rng), 'grid-numba')
+
+    rows = []
+    for nobj in sizes:
+        print('making catalog with %d objects' % nobj)
+        cat = make_catalog(nobj, rng)
+
+        for backend in backends:
+            if backend == 'brute' and nobj > max_brute_size:
+                print('skipping brute for %d objects' % nobj)
+                continue
+
+            print('running %s for %d objects' % (backend, nobj))
+            nbr_data, fof_data, tm, peak = run_backend(
+                cat,
+                backend,
+                nproc=nproc,
+            )
+            st = get_group_stats(nbr_data, fof_data)
+
+            row = np.zeros(1, dtype=get_output_dtype())
+            row['backend'] = backend
+            row['nobj'] = nobj
+            row['nproc'] = nproc
+            row['time'] = tm
+            row['peak_mem'] = peak
+            for key in st:
+                row[key] = st[key]
+
+            print_row(row[0])
+            rows.append(row)
+
+    return np.concatenate(rows)
+
+def print_row(row):
+    """
+    print a row of the benchmark output
+    """
+    print('    time: %.3g s  peak mem: %.3g MB  fofs: %d  '
+          'max size: %d  mean size: %.3g' % (
+              row['time'],
+              row['peak_mem']/1.0e6,
+              row['nfofs'],
+              row['max_size'],
+              row['mean_size'],
+          ))
+
+def write_output(fname, output, clobber=True):
+    """
+    write the benchmark output
+    """
+    print('writing:',fname)
+    fitsio.write(fname, output, extname='fof_bench', clobber=clobber)
@@ -1,6 +1,7 @@
 import os
 import shutil
 import logging
+import numpy as np
 import fitsio
 
 logger = logging.getLogger(__name__)
@@ -169,16 +170,147 @@ def get_condor_script(run, icondor):
 
 
 
-def load_fofs(fof_filename):
+def load_fofs(fof_filename, extensions=('nbrs','fofs')):
     """
     load FoF information from the file
+
+    Only the requested extensions are read.  The nbrs are stored in
+    the compact CSR format, in the nbrs_offsets and nbrs_list
+    extensions, and are converted to the nbrs table when 'nbrs' is
+    requested; older files with an nbrs table are also supported.
+    Request 'nbrs_csr' to get the offsets and nbrs list as a tuple.
+
+    parameters
+    ----------
+    fof_filename: string
+        The fof file
+    extensions: sequence, optional
+        Names of the extensions to load, default ('nbrs','fofs')
+
+    returns
+    -------
+    A tuple with the data for each requested extension
+    """
+    from .fofs import csr_to_nbrs
+
+    logger.info('loading %s: %s' % (', '.join(extensions), fof_filename))
+
+    output=[]
+    with fitsio.FITS(fof_filename) as fits:
+        for ext in extensions:
+            if ext in ('nbrs','nbrs_csr') and 'nbrs_offsets' in fits:
+                offsets=fits['nbrs_offsets'].read()
+                nbr_list=fits['nbrs_list'][:]
+                if ext == 'nbrs':
+                    output.append( csr_to_nbrs(offsets, nbr_list) )
+                else:
+                    output.append( (offsets, nbr_list) )
+            elif ext == 'nbrs_csr':
+                raise ValueError('no CSR nbrs found in %s' % fof_filename)
+            else:
+                output.append( fits[ext][:] )
+
+    return tuple(output)
+
+def load_fof_index(fof_filename):
+    """
+    load the index of the FoF groups, or None if it is not present
+    """
+    with fitsio.FITS(fof_filename) as fits:
+        if 'fof_index' not in fits:
+            return None
+        fof_index=fits['fof_index'][:]
+
+    return fof_index
+
+def load_fof_cuts(fof_filename):
+    """
+    load the links cut when splitting large FoF groups, or None if
+    no groups were split
     """
-    logger.info('loading fofs: %s' % fof_filename)
     with fitsio.FITS(fof_filename) as fits:
-        nbrs=fits['nbrs'][:]
-        fofs=fits['fofs'][:]
+        if 'fof_cuts' not in fits:
+            return None
+        fof_cuts=fits['fof_cuts'][:]
+
+    return fof_cuts
+
+def load_fof_range(fof_filename, fof_index, start, end):
+    """
+    load the rows of the fofs table for groups start through end,
+    inclusive, using the index of the groups.  The fofs table must
+    be sorted by fofid
+    """
+    row_start = fof_index['start'][start]
+    row_end = fof_index['start'][end] + fof_index['length'][end]
+
+    logger.info('loading fof rows [%d,%d): %s' % (row_start,row_end,fof_filename))
+    with fitsio.FITS(fof_filename) as fits:
+        fofs=fits['fofs'][row_start:row_end]
+
+    return fofs
+
+def load_fof_stats(fof_filename):
+    """
+    load the FoF stats from the file, or None if they are not present
+    """
+    with fitsio.FITS(fof_filename) as fits:
+        if 'fof_stats' not in fits:
+            return None
+        stats=fits['fof_stats'][:]
+
+    return stats
+
+def read_meds_columns(meds_file, columns, chunksize=100000):
+    """
+    read columns from the object_data of a MEDS file
+
+    For per-cutout columns such as orig_start_row only the first
+    cutout, the coadd, is kept, with shape (nobj,1), so the usual
+    [:,0] indexing works.  The rows are read in chunks to bound the
+    memory used for these columns.
+
+    parameters
+    ----------
+    meds_file: string
+        The MEDS file
+    columns: list
+        The columns to read
+    chunksize: int, optional
+        Number of rows to read at once, default 100000
+
+    returns
+    -------
+    cat: array
+        The catalog with the requested columns
+    """
+    logger.info('reading %s: %s' % (', '.join(columns), meds_file))
+    with fitsio.FITS(meds_file) as fits:
+        hdu = fits['object_data']
+        nrows = hdu.get_nrows()
+
+        cat = None
+        for start in range(0, nrows, chunksize):
+            end = min(start+chunksize, nrows)
+            data = hdu.read(columns=columns, rows=np.arange(start, end))
+
+            if cat is None:
+                dtype=[]
+                for name in columns:
+                    dt = data.dtype[name]
+                    if len(dt.shape) > 0:
+                        dtype.append( (name, dt.base, (1,)) )
+                    else:
+                        dtype.append( (name, dt) )
+                cat = np.zeros(nrows, dtype=dtype)
+
+            for name in columns:
+                if data[name].ndim > 1:
+                    cat[name][start:end] = data[name][:,:1]
+                else:
+                    cat[name][start:end] = data[name]
 
-    return nbrs, fofs
+    return cat
 
 class StagedOutFile(object):
     """
@@ -330,6 +330,7 @@ class MOFFitter(FitterBase):
             ('flux_auto','f4'),
             ('mag_auto','f4'),
             ('fof_id','i8'), # fof id within image
+            ('owned','i2'), # owned by this tile, see fofs.get_tile_owned
             ('flags','i4'),
             ('flagstr','U11'),
             ('masked_frac','f4'),
@@ -373,7 +374,7 @@ class MOFFitter(FitterBase):
         n=self.namer
         st[n('flags')] = st['flags']
 
-        noset=['id','ra','dec','flux_auto','mag_auto',
+        noset=['id','ra','dec','flux_auto','mag_auto','owned',
                'flags','flagstr',n('flags')]
 
         for n in st.dtype.names:
@@ -497,6 +498,7 @@ class MOFFitterGS(MOFFitter):
             ('flux_auto','f4'),
             ('mag_auto','f4'),
             ('fof_id','i8'), # fof id within image
+            ('owned','i2'), # owned by this tile, see fofs.get_tile_owned
             ('flags','i4'),
             ('flagstr','U11'),
             ('masked_frac','f4'),
@@ -650,6 +652,7 @@ class MOFFluxFitterGS(MOFFitterGS):
             ('flux_auto','f4'),
             ('mag_auto','f4'),
             ('fof_id','i8'), # fof id within image
+            ('owned','i2'), # owned by this tile, see fofs.get_tile_owned
             ('flags','i4'),
             ('flagstr','U11'),
             ('masked_frac','f4'),
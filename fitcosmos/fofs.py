@@ -1,17 +1,42 @@
 import os
-import copy
+import multiprocessing
 import numpy as np
 import mof
 
 from .pbar import prange
 
-def get_fofs(meds_list, fof_conf):
+def get_fofs(meds_list, fof_conf, nproc=1, tile_size=None):
+    """
+    get the nbrs table and FoF groups
+
+    parameters
+    ----------
+    meds_list: MEDS
+        The MEDS object, or anything with the same catalog columns
+    fof_conf: dict
+        The fofs section of the config
+    nproc: int, optional
+        Number of processes for the nbrs search
+    tile_size: float, optional
+        If sent, build the groups in square sky tiles of this size
+        in arcsec, see TiledFoF.  The result is identical to the
+        global run.
+    """
+    if tile_size is not None:
+        tf = TiledFoF(
+            meds_list,
+            fof_conf,
+            tile_size,
+            nproc=nproc,
+        )
+        return tf.go()
+
     mn=MEDSNbrs(
         meds_list,
         fof_conf,
     )
 
-    nbr_data = mn.get_nbrs()
+    nbr_data = mn.get_nbrs(nproc=nproc)
 
     nf = NbrsFoF(nbr_data)
     fofs = nf.get_fofs()
@@ -37,11 +62,33 @@ class MEDSNbrs(object):
         maxsize - size ot use instead of maxsize_to_replace to compute overlap
 
         check_seg - use object's seg map to get nbrs in addition to postage stamp overlap
+        seg_chunk_pixels - maximum number of seg pixels to read at once
+            when checking the seg maps, see SegNbrs
+
+        nbrs_backend - how to search for overlapping boxes
+            'grid': bucket the boxes into a uniform grid and only test
+                boxes that share a grid cell (default)
+            'brute': test every box against the full catalog
+
+        grid_cell_arcsec - size of the grid cells, default is the median
+            box size
+
+        engine - how to run the box overlap tests
+            'numpy': vectorized numpy (default)
+            'numba': compiled loops; falls back to numpy if numba is
+                not available.  The nbrs are identical for both engines
+
+        min_link_weight - drop links with an overlap weight below this
+            value, default 0.  The weight is the area of the intersection
+            of the boxes divided by the area of the smaller box, see
+            get_link_weights.  Links found in the seg maps have weight 1
+            and are always kept.
     """
 
     def __init__(self,meds,conf,cat=None):
         self.meds = meds
         self.conf = conf
+        self.engine = _get_engine(conf)
 
         self._init_bounds()
 
@@ -54,44 +101,116 @@ class MEDSNbrs(object):
 
     def _init_bounds_by_radius(self):
 
-        radius_name=self.conf['radius_column']
-
-        min_radius=self.conf.get('min_radius_arcsec',None)
-        if min_radius is None:
-            # arcsec
-            min_radius=1.0
-
-        max_radius=self.conf.get('max_radius_arcsec',None)
-        if max_radius is None:
-            max_radius=np.inf
-
         m=self.meds
 
         med_ra = np.median( m['ra'] )
         med_dec = np.median( m['dec'] )
 
-        r = m[radius_name].copy()
-
-        r *= self.conf['radius_mult']
-
-        r.clip(min=min_radius, max=max_radius, out=r)
-
-        r += self.conf['padding_arcsec']
-
-        # factor of 2 because this should be a diameter as it is used later
-        diameter = r*2
-        self.sze = diameter
+        self.l, self.r, self.b, self.t, self.sze = get_radius_bounds(
+            m['ra'],
+            m['dec'],
+            m[self.conf['radius_column']],
+            self.conf,
+            med_ra,
+            med_dec,
+        )
 
-        ra_diff = (m['ra'] - med_ra)*3600.0
-        dec_diff = (m['dec'] - med_dec)*3600.0
+    def get_nbrs(self,verbose=True,nproc=1):
+        """
+        get the nbrs table
+
+        parameters
+        ----------
+        verbose: bool, optional
+            show progress for the brute force search
+        nproc: int, optional
+            number of processes to use for the grid search, default 1
+        """
+        backend = self.conf.get('nbrs_backend','grid')
+        if backend == 'grid':
+            ind1, ind2 = self._get_pairs_grid(nproc=nproc)
+        elif backend == 'brute':
+            if self.engine == 'numba':
+                ind1, ind2 = self._get_pairs_brute_numba()
+            else:
+                nbrs_data = self._get_nbrs_brute(verbose=verbose)
+                ind1, ind2 = _nbrs_data_to_pairs(nbrs_data)
+        else:
+            raise ValueError("bad nbrs_backend '%s', should be "
+                             "'grid' or 'brute'" % backend)
+
+        weight = get_link_weights(self.l, self.r, self.b, self.t, ind1, ind2)
+        ind1, ind2, weight = _prune_links(ind1, ind2, weight, self.conf)
+
+        if self.conf.get('check_seg',False):
+            ind1, ind2, weight = self._add_seg_pairs(ind1, ind2, weight)
+
+        return _pairs_to_nbrs_data(self.meds['number'], ind1, ind2, weight)
+
+    def _add_seg_pairs(self, ind1, ind2, weight, indices=None):
+        """
+        add links found in the seg maps of the stamps
+        """
+        sn = SegNbrs(self.meds, self.conf)
+        sind1, sind2 = sn.get_pairs(indices=indices)
+        sweight = np.ones(sind1.size*2)
+
+        return _unique_pairs(
+            np.concatenate( [ind1, sind1, sind2] ),
+            np.concatenate( [ind2, sind2, sind1] ),
+            self.meds.size,
+            weight=np.concatenate( [weight, sweight] ),
+        )
 
-        self.l = ra_diff - r
-        self.r = ra_diff + r
-        self.b = dec_diff - r
-        self.t = dec_diff + r
+    def _get_good(self):
+        """
+        objects with a valid stamp
+        """
+        return _get_good_stamps(self.meds)
+
+    def _get_pairs_grid(self, nproc=1):
+        """
+        find all overlapping boxes using a uniform grid
+
+        Each box is placed in every grid cell it touches, and only boxes
+        sharing a cell are tested against each other.  The cost scales
+        as the number of boxes times the typical cell occupancy rather
+        than the square of the catalog size.
+        """
+        good = self._get_good()
+
+        cell_size = self.conf.get('grid_cell_arcsec',None)
+        if cell_size is None:
+            if good.any():
+                cell_size = np.median(self.sze[good])
+            else:
+                cell_size = 1.0
 
+        grid = BoxGrid(
+            self.l, self.r, self.b, self.t,
+            cell_size,
+            indices=np.where(good)[0],
+            engine=self.engine,
+        )
+        return grid.get_pairs(nproc=nproc)
+
+    def _get_pairs_brute_numba(self, rows=None):
+        """
+        test the boxes of the input rows, default all objects with
+        valid stamps, against all others using the compiled kernel
+        """
+        good = self._get_good()
+        if rows is None:
+            rows, = np.where(good)
+
+        kernels = _get_numba_kernels()
+        return kernels['brute_pairs'](
+            np.asarray(rows, dtype='i8'),
+            good,
+            self.l, self.r, self.b, self.t,
+        )
 
-    def get_nbrs(self,verbose=True):
+    def _get_nbrs_brute(self,verbose=True):
         #data types
         nbrs_data = []
         dtype = [('number','i8'),('nbr_number','i8')]
@@ -203,14 +322,1279 @@ class MEDSNbrs(object):
         return nbr_numbers
 
 
+def get_radius_bounds(ra, dec, rad, conf, med_ra, med_dec):
+    """
+    get the box edges, in arcsec relative to the reference point,
+    based on the radius column
+
+    parameters
+    ----------
+    ra, dec: arrays
+        positions in degrees
+    rad: array
+        radius in arcsec, not modified
+    conf: dict
+        fofs config
+    med_ra, med_dec: float
+        reference position
+
+    returns
+    -------
+    l, r, b, t, sze: arrays
+        The box edges and the box size
+    """
+    r = _get_link_radius(rad, conf)
+
+    # factor of 2 because this should be a diameter as it is used later
+    diameter = r*2
+
+    ra_diff = (ra - med_ra)*3600.0
+    dec_diff = (dec - med_dec)*3600.0
+
+    l = ra_diff - r
+    r_edge = ra_diff + r
+    b = dec_diff - r
+    t = dec_diff + r
+
+    return l, r_edge, b, t, diameter
+
+def get_link_weights(l, r, b, t, ind1, ind2):
+    """
+    get the overlap weight for pairs of boxes
+
+    The weight is the area of the intersection divided by the area
+    of the smaller box, so it is 1 when one box holds the other and
+    goes to zero for boxes that barely touch
+
+    parameters
+    ----------
+    l, r, b, t: arrays
+        left, right, bottom and top edges of the boxes
+    ind1, ind2: arrays
+        indices of the pairs
+
+    returns
+    -------
+    weight: array
+        The weight for each pair
+    """
+    dx = np.minimum(r[ind1], r[ind2]) - np.maximum(l[ind1], l[ind2])
+    dy = np.minimum(t[ind1], t[ind2]) - np.maximum(b[ind1], b[ind2])
+    dx.clip(min=0, out=dx)
+    dy.clip(min=0, out=dy)
+
+    area1 = (r[ind1]-l[ind1])*(t[ind1]-b[ind1])
+    area2 = (r[ind2]-l[ind2])*(t[ind2]-b[ind2])
+
+    return dx*dy/np.minimum(area1, area2)
+
+def _prune_links(ind1, ind2, weight, conf):
+    """
+    drop links with weight below min_link_weight
+    """
+    min_weight = conf.get('min_link_weight',0.0)
+
+    w, = np.where(weight >= min_weight)
+    return ind1[w], ind2[w], weight[w]
+
+def _get_link_radius(rad, conf):
+    """
+    get the half size of the boxes from the radius
+    """
+    min_radius=conf.get('min_radius_arcsec',None)
+    if min_radius is None:
+        # arcsec
+        min_radius=1.0
+
+    max_radius=conf.get('max_radius_arcsec',None)
+    if max_radius is None:
+        max_radius=np.inf
+
+    r = rad.copy()
+
+    r *= conf['radius_mult']
+
+    r.clip(min=min_radius, max=max_radius, out=r)
+
+    r += conf['padding_arcsec']
+
+    return r
+
+def _get_good_stamps(m):
+    """
+    objects with a valid stamp
+    """
+    return (
+        (m['orig_start_row'][:,0] != -9999)
+        &
+        (m['orig_start_col'][:,0] != -9999)
+    )
+
+
+class SegNbrs(object):
+    """
+    find nbrs using the seg maps of the coadd stamps
+
+    Any other object whose seg id appears in the seg map of an
+    object's first cutout is a nbr.  The seg cutouts are read in bulk:
+    the stamps are sorted by their offset in the file and adjacent
+    stamps are read with single contiguous reads of at most
+    seg_chunk_pixels pixels.  The foreign seg ids for all the stamps in
+    a chunk are found with a single vectorized np.unique.
+
+    parameters
+    ----------
+    meds: MEDS
+        The MEDS object.  The seg cutouts are read from its fits file.
+    conf: dict
+        The fofs config
+    """
+    def __init__(self, meds, conf):
+        self.meds = meds
+        self.conf = conf
+        self.max_pixels = conf.get('seg_chunk_pixels', 2**22)
+
+    def get_pairs(self, indices=None):
+        """
+        get the links found in the seg maps
+
+        parameters
+        ----------
+        indices: array, optional
+            Only check the stamps of these objects.  Default is all
+            objects with a valid stamp
+
+        returns
+        -------
+        ind1, ind2: arrays
+            The seg map of object ind1 holds pixels of object ind2.
+            Pairs are not symmetric.
+        """
+        m = self.meds
+
+        if indices is None:
+            indices, = np.where(_get_good_stamps(m))
+
+        w, = np.where(m['ncutout'][indices] > 0)
+        indices = indices[w]
+
+        start_row = m['start_row'][indices,0]
+        s = start_row.argsort()
+        indices = indices[s]
+
+        ind1_list=[]
+        ind2_list=[]
+        for chunk in self._get_chunks(indices):
+            ind1, ind2 = self._get_chunk_pairs(chunk)
+            ind1_list.append(ind1)
+            ind2_list.append(ind2)
+
+        if len(ind1_list) == 0:
+            return np.zeros(0, dtype='i8'), np.zeros(0, dtype='i8')
+
+        return np.concatenate(ind1_list), np.concatenate(ind2_list)
+
+    def _get_chunks(self, indices):
+        """
+        split the objects, sorted by offset, into chunks that are
+        read together
+        """
+        m = self.meds
+
+        start = m['start_row'][indices,0].astype('i8')
+        end = start + m['box_size'][indices].astype('i8')**2
+
+        chunks=[]
+        ichunk = 0
+        for i in range(1, indices.size+1):
+            if i == indices.size or end[i] - start[ichunk] > self.max_pixels:
+                chunks.append(indices[ichunk:i])
+                ichunk = i
+
+        return chunks
+
+    def _get_chunk_pairs(self, chunk):
+        """
+        read the seg maps for a chunk of objects and find the
+        foreign seg ids
+        """
+        m = self.meds
+        number = m['number']
+
+        start = m['start_row'][chunk,0].astype('i8')
+        npix = m['box_size'][chunk].astype('i8')**2
+
+        row0 = start[0]
+        row1 = (start + npix).max()
+        seg = m._fits['seg_cutouts'][row0:row1]
+
+        # pixel indices for all the stamps
+        iobj = np.repeat(np.arange(chunk.size), npix)
+        offsets = np.zeros(chunk.size, dtype='i8')
+        offsets[1:] = npix.cumsum()[:-1]
+        pix = start[iobj] - row0 + np.arange(iobj.size) - offsets[iobj]
+
+        segnum = seg[pix].astype('i8')
+        w, = np.where( (segnum > 0) & (segnum != number[chunk[iobj]]) )
+
+        maxnum = number.max()+1
+        keys = np.unique(iobj[w]*maxnum + segnum[w])
+        ind1 = chunk[keys // maxnum]
+        nbr_number = keys % maxnum
+
+        # seg ids are the object numbers
+        ind2 = nbr_number - 1
+        good = _get_good_stamps(m)
+        w, = np.where(
+            (ind2 < m.size)
+            &
+            (number[ind2.clip(max=m.size-1)] == nbr_number)
+            &
+            good[ind2.clip(max=m.size-1)]
+        )
+        return ind1[w], ind2[w]
+
+
+class TiledFoF(object):
+    """
+    build the nbrs and FoF groups in square sky tiles
+
+    Each tile holds the objects with centers inside the tile plus a
+    halo of objects from the surrounding tiles.  The halo is the largest
+    possible link length, twice the largest box half size, so every link
+    of an object in the tile is found while processing that tile.  Links
+    to halo objects stitch the groups across tile edges through a
+    disjoint set over the full catalog.
+
+    The box edges, grid and candidate pairs are made for one tile at a
+    time, but the links found in every tile are kept and the full nbrs
+    table is built at the end, so the peak memory is set by the number
+    of links in the catalog, not by the tile size.  The nbrs and FoF
+    groups are identical to those from a global run.
+
+    parameters
+    ----------
+    meds: MEDS
+        The MEDS object, or anything with the same catalog columns
+    conf: dict
+        The fofs config
+    tile_size: float
+        Size of the tiles in arcsec.  Tiles smaller than the halo are
+        expanded to the halo size.
+    nproc: int, optional
+        Number of processes for the pair search in each tile
+    """
+    def __init__(self, meds, conf, tile_size, nproc=1):
+        assert conf['method'] == 'radius','only radius method supported for tiles'
+        assert tile_size > 0,'tile size must be positive'
+
+        self.meds = meds
+        self.conf = conf
+        self.tile_size = tile_size
+        self.nproc = nproc
+        self.engine = _get_engine(conf)
+
+        self._set_tiles()
+
+    def go(self):
+        """
+        get the nbrs table and FoF groups
+
+        returns
+        -------
+        nbr_data, fofs: arrays
+            Same as returned by get_fofs
+        """
+        m = self.meds
+        dset = DisjointSet(m.size)
+
+        ind1_list=[]
+        ind2_list=[]
+        weight_list=[]
+
+        for itile in prange(self.tile_starts.size):
+            ind1, ind2, weight = self._get_tile_pairs(itile)
+
+            w, = np.where(ind1 < ind2)
+            for i, j in zip(ind1[w], ind2[w]):
+                dset.union(i, j)
+
+            ind1_list.append(ind1)
+            ind2_list.append(ind2)
+            weight_list.append(weight)
+
+        if len(ind1_list) > 0:
+            ind1 = np.concatenate(ind1_list)
+            ind2 = np.concatenate(ind2_list)
+            weight = np.concatenate(weight_list)
+        else:
+            ind1 = np.zeros(0, dtype='i8')
+            ind2 = np.zeros(0, dtype='i8')
+            weight = np.zeros(0)
+
+        if self.conf.get('check_seg',False):
+            # seg links can be found from both stamps
+            ind1, ind2, weight = _unique_pairs(ind1, ind2, m.size, weight=weight)
+
+        nbr_data = _pairs_to_nbrs_data(m['number'], ind1, ind2, weight)
+
+        fofs = np.zeros(m.size, dtype=[('fofid','i8'),('number','i8')])
+        fofs['fofid'] = dset.get_labels()
+        fofs['number'] = np.arange(1, m.size+1)
+
+        return nbr_data, fofs
+
+    def _set_tiles(self):
+        """
+        assign objects with valid stamps to tiles, and sort them
+        by tile id
+        """
+        m = self.meds
+
+        self.med_ra = np.median( m['ra'] )
+        self.med_dec = np.median( m['dec'] )
+
+        good, = np.where(_get_good_stamps(m))
+        if good.size > 0:
+            r = _get_link_radius(m[self.conf['radius_column']][good], self.conf)
+            self.halo = 2*r.max()
+        else:
+            self.halo = 0.0
+
+        self.tsize = max(self.tile_size, self.halo)
+
+        x = (m['ra'][good] - self.med_ra)*3600.0
+        y = (m['dec'][good] - self.med_dec)*3600.0
+
+        if good.size > 0:
+            self.xmin = x.min()
+            self.ymin = y.min()
+        else:
+            self.xmin = self.ymin = 0.0
+
+        ix = np.floor((x - self.xmin)/self.tsize).astype('i8')
+        iy = np.floor((y - self.ymin)/self.tsize).astype('i8')
+        if good.size > 0:
+            self.ntx = ix.max()+1
+        else:
+            self.ntx = 1
+
+        tile = iy*self.ntx + ix
+
+        s = tile.argsort(kind='mergesort')
+        self.obj = good[s]
+        self.x = x[s]
+        self.y = y[s]
+        self.obj_tile = tile[s]
+
+        self.tiles, self.tile_starts, self.tile_counts = np.unique(
+            self.obj_tile,
+            return_index=True,
+            return_counts=True,
+        )
+
+    def _get_tile_members(self, itile):
+        """
+        get the sorted positions of the objects in the tile and in
+        its halo, and a bool array marking those owned by the tile
+        """
+        tile = self.tiles[itile]
+        tix = tile % self.ntx
+        tiy = tile // self.ntx
+
+        x0 = self.xmin + tix*self.tsize - self.halo
+        x1 = self.xmin + (tix+1)*self.tsize + self.halo
+        y0 = self.ymin + tiy*self.tsize - self.halo
+        y1 = self.ymin + (tiy+1)*self.tsize + self.halo
+
+        # the halo is no larger than a tile, so only the neighboring
+        # tiles need to be checked
+        plist=[]
+        for diy in (-1,0,1):
+            for dix in (-1,0,1):
+                nix = tix + dix
+                if nix < 0 or nix >= self.ntx:
+                    continue
+
+                ntile = tile + diy*self.ntx + dix
+                i = np.searchsorted(self.tiles, ntile)
+                if i < self.tiles.size and self.tiles[i] == ntile:
+                    start = self.tile_starts[i]
+                    plist.append(
+                        np.arange(start, start+self.tile_counts[i])
+                    )
+
+        pos = np.concatenate(plist)
+        w, = np.where(
+            (self.x[pos] >= x0) & (self.x[pos] <= x1)
+            &
+            (self.y[pos] >= y0) & (self.y[pos] <= y1)
+        )
+        pos = pos[w]
+
+        owned = self.obj_tile[pos] == tile
+        return pos, owned
+
+    def _get_tile_pairs(self, itile):
+        """
+        get all links of objects owned by the tile, as indices into
+        the full catalog, and the link weights
+        """
+        m = self.meds
+
+        pos, owned = self._get_tile_members(itile)
+        ind = self.obj[pos]
+
+        l, r, b, t, sze = get_radius_bounds(
+            m['ra'][ind],
+            m['dec'][ind],
+            m[self.conf['radius_column']][ind],
+            self.conf,
+            self.med_ra,
+            self.med_dec,
+        )
+
+        cell_size = self.conf.get('grid_cell_arcsec',None)
+        if cell_size is None:
+            cell_size = np.median(sze)
+
+        grid = BoxGrid(l, r, b, t, cell_size, engine=self.engine)
+        ind1, ind2 = grid.get_pairs(nproc=self.nproc)
+
+        w, = np.where(owned[ind1])
+        ind1 = ind1[w]
+        ind2 = ind2[w]
+
+        weight = get_link_weights(l, r, b, t, ind1, ind2)
+        ind1, ind2, weight = _prune_links(ind1, ind2, weight, self.conf)
+
+        ind1 = ind[ind1]
+        ind2 = ind[ind2]
+
+        if self.conf.get('check_seg',False):
+            sn = SegNbrs(m, self.conf)
+            sind1, sind2 = sn.get_pairs(indices=ind[owned])
+            ind1 = np.concatenate( [ind1, sind1, sind2] )
+            ind2 = np.concatenate( [ind2, sind2, sind1] )
+            weight = np.concatenate( [weight, np.ones(sind1.size*2)] )
+
+        return ind1, ind2, weight
+
+
+class IncrementalFoF(object):
+    """
+    update existing nbrs and FoF groups for a changed catalog
+
+    Objects are matched between the old and new catalogs by id.  Added
+    objects, and objects whose position, radius or stamp status changed,
+    are "dirty": their nbrs are recomputed against the new catalog.
+    Links between unchanged objects are carried over from the old
+    nbrs table.
+
+    Only the groups that contain dirty or removed objects, or that
+    are linked to dirty objects, are re-linked.  All other groups keep
+    their old fofid.  New groups take the fofids freed by the affected
+    groups first, and then new ids are added at the end.  If fewer ids
+    are needed, unchanged groups with the highest ids are moved into
+    the remaining holes so that the fofids stay contiguous.
+
+    parameters
+    ----------
+    meds: MEDS
+        The new MEDS object, or anything with the same catalog columns
+    conf: dict
+        The fofs config
+    old_nbrs: array
+        The nbrs table from the existing fof file
+    old_fofs: array
+        The fofs table from the existing fof file
+    old_cat: array
+        The old catalog, indexed by number-1, with id, ra, dec,
+        orig_start_row, orig_start_col and the radius column
+    """
+    def __init__(self, meds, conf, old_nbrs, old_fofs, old_cat):
+        self.meds = meds
+        self.conf = conf
+        self.old_nbrs = old_nbrs
+        self.old_fofs = old_fofs
+        self.old_cat = old_cat
+
+        self._match()
+
+    def go(self):
+        """
+        get the updated nbrs and FoF groups
+
+        returns
+        -------
+        nbr_data, fofs, fof_map: arrays
+            The nbrs and fofs tables as returned by get_fofs, and
+            a table with one row per new fofid holding the old fofid
+            for unchanged groups, -1 otherwise, and a changed flag
+        """
+        ind1, ind2, weight = self._get_pairs()
+        nbr_data = _pairs_to_nbrs_data(self.meds['number'], ind1, ind2, weight)
+
+        fofs, fof_map = self._get_fofs(ind1, ind2)
+        return nbr_data, fofs, fof_map
+
+    def _match(self):
+        """
+        match the old and new catalogs and find the dirty objects
+        """
+        m = self.meds
+        old_cat = self.old_cat
+        radcol = self.conf['radius_column']
+
+        ids, mold, mnew = np.intersect1d(
+            old_cat['id'],
+            m['id'],
+            assume_unique=True,
+            return_indices=True,
+        )
+
+        new_good = _get_good_stamps(m)
+        old_good = _get_good_stamps(old_cat)
+
+        modified = (
+            (old_cat['ra'][mold] != m['ra'][mnew])
+            |
+            (old_cat['dec'][mold] != m['dec'][mnew])
+            |
+            (old_cat[radcol][mold] != m[radcol][mnew])
+            |
+            (old_good[mold] != new_good[mnew])
+        )
+
+        # index in new catalog for each old object, -1 if removed
+        # or modified
+        self.old2new = np.zeros(old_cat.size, dtype='i8') - 1
+        self.old2new[mold[~modified]] = mnew[~modified]
+
+        # the dirty objects in the new catalog
+        self.dirty = np.ones(m.size, dtype=bool)
+        self.dirty[mnew[~modified]] = False
+
+        # old objects that were removed or modified
+        self.old_changed = np.ones(old_cat.size, dtype=bool)
+        self.old_changed[mold[~modified]] = False
+
+        print('added:',m.size-mnew.size)
+        print('removed:',old_cat.size-mold.size)
+        print('modified:',modified.sum())
+
+    def _get_pairs(self):
+        """
+        get all links for the new catalog, as indices into the
+        new catalog, and the link weights
+
+        Links carried over from the old table keep their weight.  Old
+        tables without weights get the box overlap weight, but are
+        not pruned, so the unchanged groups stay the same.
+        """
+        mn = MEDSNbrs(self.meds, self.conf)
+
+        # links carried over from the old table
+        old_nbrs = self.old_nbrs
+        w, = np.where(old_nbrs['nbr_number'] > 0)
+        old_ind1 = self.old2new[old_nbrs['number'][w]-1]
+        old_ind2 = self.old2new[old_nbrs['nbr_number'][w]-1]
+        if 'weight' in old_nbrs.dtype.names:
+            old_weight = old_nbrs['weight'][w].astype('f8')
+        else:
+            old_weight = None
+
+        w, = np.where( (old_ind1 >= 0) & (old_ind2 >= 0) )
+        old_ind1 = old_ind1[w]
+        old_ind2 = old_ind2[w]
+        if old_weight is not None:
+            old_weight = old_weight[w]
+        else:
+            old_weight = get_link_weights(
+                mn.l, mn.r, mn.b, mn.t, old_ind1, old_ind2,
+            )
+
+        # links for the dirty objects, in both directions
+        new_ind1, new_ind2, new_weight = self._get_dirty_pairs(mn)
+        self.dirty_ind1 = new_ind1
+        self.dirty_ind2 = new_ind2
+
+        ind1 = np.concatenate( [old_ind1, new_ind1, new_ind2] )
+        ind2 = np.concatenate( [old_ind2, new_ind2, new_ind1] )
+        weight = np.concatenate( [old_weight, new_weight, new_weight] )
+
+        # pairs of dirty objects are found from both sides
+        return _unique_pairs(ind1, ind2, self.meds.size, weight=weight)
+
+    def _get_dirty_pairs(self, mn):
+        """
+        test each dirty object against the full catalog, using the box
+        edges from the input MEDSNbrs
+
+        Links below min_link_weight are dropped.  When check_seg is set, the seg maps of the dirty objects are
+        also checked.  Note the stamps of unchanged objects are not
+        re-read, so seg links to dirty objects are only found from the
+        dirty object's stamp.
+        """
+        m = self.meds
+        good = mn._get_good()
+        l, r, b, t = mn.l, mn.r, mn.b, mn.t
+
+        ind1_list=[]
+        ind2_list=[]
+
+        dirty, = np.where(self.dirty & good)
+        if mn.engine == 'numba':
+            ind1, ind2 = mn._get_pairs_brute_numba(rows=dirty)
+        else:
+            for i in dirty:
+                q, = np.where(
+                    (l[i] < r) & (r[i] > l)
+                    &
+                    (t[i] > b) & (b[i] < t)
+                    &
+                    good
+                )
+                q = q[q != i]
+                ind1_list.append(np.zeros(q.size, dtype='i8') + i)
+                ind2_list.append(q)
+
+            if len(ind1_list) > 0:
+                ind1 = np.concatenate(ind1_list)
+                ind2 = np.concatenate(ind2_list)
+            else:
+                ind1 = np.zeros(0, dtype='i8')
+                ind2 = np.zeros(0, dtype='i8')
+
+        weight = get_link_weights(l, r, b, t, ind1, ind2)
+        ind1, ind2, weight = _prune_links(ind1, ind2, weight, self.conf)
+
+        if self.conf.get('check_seg',False):
+            sn = SegNbrs(m, self.conf)
+            sind1, sind2 = sn.get_pairs(indices=dirty)
+            ind1 = np.concatenate( [ind1, sind1] )
+            ind2 = np.concatenate( [ind2, sind2] )
+            weight = np.concatenate( [weight, np.ones(sind1.size)] )
+
+        return ind1, ind2, weight
+
+    def _get_fofs(self, ind1, ind2):
+        """
+        re-link the affected groups and assign fofids
+        """
+        nobj = self.meds.size
+
+        # old fofid for each new object, -1 for dirty objects
+        old_fofid_by_number = np.zeros(self.old_cat.size, dtype='i8')
+        old_fofid_by_number[self.old_fofs['number']-1] = self.old_fofs['fofid']
+        old_nfof = self.old_fofs['fofid'].max()+1
+
+        old_fofid = np.zeros(nobj, dtype='i8') - 1
+        w, = np.where(self.old2new >= 0)
+        old_fofid[self.old2new[w]] = old_fofid_by_number[w]
+
+        # groups that lost members, or are linked to dirty objects
+        affected_fofids = np.union1d(
+            old_fofid_by_number[self.old_changed],
+            old_fofid[self.dirty_ind2],
+        )
+        affected_fofids = affected_fofids[affected_fofids >= 0]
+
+        affected = self.dirty | np.isin(old_fofid, affected_fofids)
+        aind, = np.where(affected)
+        print('re-linking %d objects' % aind.size)
+
+        # link the affected objects, all of their links are to other
+        # affected objects
+        local = np.zeros(nobj, dtype='i8') - 1
+        local[aind] = np.arange(aind.size)
+
+        w, = np.where(affected[ind1] & (ind1 < ind2))
+        dset = DisjointSet(aind.size)
+        for i, j in zip(local[ind1[w]], local[ind2[w]]):
+            dset.union(i, j)
+
+        new_labels = dset.get_labels()
+        nnew = new_labels.max()+1 if aind.size > 0 else 0
+
+        # unchanged groups keep their fofid where possible
+        kept, = np.where(~affected)
+        kept_fofids = np.unique(old_fofid[kept])
+        ntotal = kept_fofids.size + nnew
+
+        available = np.setdiff1d(
+            np.arange(ntotal),
+            kept_fofids,
+            assume_unique=True,
+        )
+        movers = kept_fofids[kept_fofids >= ntotal]
+
+        fofid_map = np.arange(max(old_nfof, ntotal))
+        fofid_map[movers] = available[nnew:]
+
+        fofs = np.zeros(nobj, dtype=[('fofid','i8'),('number','i8')])
+        fofs['number'] = np.arange(1, nobj+1)
+        fofs['fofid'][kept] = fofid_map[old_fofid[kept]]
+        fofs['fofid'][aind] = available[:nnew][new_labels]
+
+        assert np.unique(fofs['fofid']).size == ntotal
+        assert fofs['fofid'].max() == ntotal-1
+
+        fof_map = np.zeros(
+            ntotal,
+            dtype=[('fofid','i8'),('old_fofid','i8'),('changed','i2')],
+        )
+        fof_map['fofid'] = np.arange(ntotal)
+        fof_map['old_fofid'] = -1
+        fof_map['changed'] = 1
+        fof_map['old_fofid'][fofid_map[kept_fofids]] = kept_fofids
+        fof_map['changed'][fofid_map[kept_fofids]] = 0
+
+        print('changed groups: %d/%d' % (nnew, ntotal))
+        return fofs, fof_map
+
+
+class BoxGrid(object):
+    """
+    uniform grid of axis aligned boxes, used to find all pairs
+    of overlapping boxes
+
+    parameters
+    ----------
+    l, r, b, t: arrays
+        left, right, bottom and top edges of the boxes
+    cell_size: float
+        size of the grid cells, in the same units as the edges
+    indices: array, optional
+        subset of boxes to place in the grid, default all
+    max_pairs: int, optional
+        maximum number of candidate pairs to test at once, this
+        bounds the working memory
+    engine: string, optional
+        'numpy' or 'numba', default 'numpy'
+    """
+    def __init__(self, l, r, b, t, cell_size,
+                 indices=None, max_pairs=2**22, engine='numpy'):
+        assert cell_size > 0,'cell_size must be positive'
+        assert engine in ('numpy','numba'),'bad engine %s' % engine
+
+        self.l = l
+        self.r = r
+        self.b = b
+        self.t = t
+        self.cell_size = cell_size
+        self.max_pairs = max_pairs
+        self.engine = engine
+
+        if indices is None:
+            indices = np.arange(l.size)
+        self.indices = np.atleast_1d(np.asarray(indices, dtype='i8'))
+
+        self._make_grid()
+
+    def get_pairs(self, nproc=1):
+        """
+        get all ordered pairs of overlapping boxes
+
+        parameters
+        ----------
+        nproc: int, optional
+            number of processes to use.  The box edges and grid are
+            placed in shared memory and the chunks of entries are
+            distributed over a process pool.  Default 1.
+
+        returns
+        -------
+        ind1, ind2: arrays
+            indices of the overlapping boxes; each pair appears
+            once in each order
+        """
+        if nproc > 1:
+            max_pairs = self.ent_count.sum()//(4*nproc) + 1
+            chunks = self._get_chunks(max_pairs=min(max_pairs, self.max_pairs))
+        else:
+            chunks = self._get_chunks()
+
+        if nproc > 1 and len(chunks) > 1:
+            pool = multiprocessing.Pool(
+                processes=nproc,
+                initializer=_init_pool_grid,
+                initargs=(self._get_shared_state(),),
+            )
+            try:
+                results = pool.map(_get_pool_grid_pairs, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [
+                self._get_chunk_pairs(start, end) for start,end in chunks
+            ]
+
+        if len(results) == 0:
+            return np.zeros(0, dtype='i8'), np.zeros(0, dtype='i8')
+
+        ind1 = np.concatenate([res[0] for res in results])
+        ind2 = np.concatenate([res[1] for res in results])
+        return ind1, ind2
+
+    def _get_shared_state(self):
+        """
+        copy the arrays needed for the pair search into shared memory
+        """
+        state = {
+            'cell_size':self.cell_size,
+            'engine':self.engine,
+            'xmin':self.xmin,
+            'ymin':self.ymin,
+            'nx':self.nx,
+        }
+        for name in self._shared_names:
+            state[name] = _to_shared(getattr(self, name))
+        return state
+
+    @classmethod
+    def _from_shared_state(cls, state):
+        """
+        make a grid that uses the arrays in shared memory
+        """
+        self = cls.__new__(cls)
+        for name in ('cell_size','engine','xmin','ymin','nx'):
+            setattr(self, name, state[name])
+        for name in cls._shared_names:
+            setattr(self, name, _from_shared(state[name]))
+        return self
+
+    _shared_names = (
+        'l','r','b','t',
+        'ent_obj','ent_cell','ent_first','ent_count',
+    )
+
+    def _get_cell(self, x, y):
+        """
+        get the grid cell ids for the input positions
+        """
+        ix = np.floor((x - self.xmin)/self.cell_size).astype('i8')
+        iy = np.floor((y - self.ymin)/self.cell_size).astype('i8')
+        return ix, iy
+
+    def _make_grid(self):
+        """
+        place the boxes in all cells they touch, and sort the
+        entries by cell id
+        """
+        ind = self.indices
+        if ind.size == 0:
+            self.xmin = self.ymin = 0.0
+            self.nx = 1
+            self.ent_obj = np.zeros(0, dtype='i8')
+            self.ent_cell = np.zeros(0, dtype='i8')
+            self.ent_first = np.zeros(0, dtype='i8')
+            self.ent_count = np.zeros(0, dtype='i8')
+            return
+
+        self.xmin = self.l[ind].min()
+        self.ymin = self.b[ind].min()
+
+        ix0, iy0 = self._get_cell(self.l[ind], self.b[ind])
+        ix1, iy1 = self._get_cell(self.r[ind], self.t[ind])
+        self.nx = ix1.max()+1
+
+        nxcell = ix1-ix0+1
+        nycell = iy1-iy0+1
+        ncell = nxcell*nycell
+
+        # one entry for each cell touched by each box
+        iobj = np.repeat(np.arange(ind.size), ncell)
+        offsets = np.zeros(ind.size, dtype='i8')
+        offsets[1:] = ncell.cumsum()[:-1]
+        k = np.arange(iobj.size) - offsets[iobj]
+
+        ix = ix0[iobj] + k % nxcell[iobj]
+        iy = iy0[iobj] + k // nxcell[iobj]
+        cell = iy*self.nx + ix
+
+        s = cell.argsort(kind='mergesort')
+        self.ent_obj = ind[iobj[s]]
+        self.ent_cell = cell[s]
+
+        # first entry and number of entries in the cell of each entry
+        ucell, first, count = np.unique(
+            self.ent_cell,
+            return_index=True,
+            return_counts=True,
+        )
+        icell = np.searchsorted(ucell, self.ent_cell)
+        self.ent_first = first[icell]
+        self.ent_count = count[icell]
+
+    def _get_chunks(self, max_pairs=None):
+        """
+        ranges of entries with a bounded number of candidate pairs
+        """
+        if max_pairs is None:
+            max_pairs = self.max_pairs
+
+        nent = self.ent_obj.size
+        if nent == 0:
+            return []
+
+        cumpairs = self.ent_count.cumsum()
+
+        chunks=[]
+        start=0
+        while start < nent:
+            if start > 0:
+                target = cumpairs[start-1] + max_pairs
+            else:
+                target = max_pairs
+            end = np.searchsorted(cumpairs, target, side='right')
+            if end <= start:
+                end = start+1
+            chunks.append( (start, end) )
+            start = end
+
+        return chunks
+
+    def _get_chunk_pairs(self, start, end):
+        """
+        test all candidates for the entries in [start,end)
+
+        A pair of boxes can share more than one cell; the pair is
+        only kept in the cell holding the lower left corner of the
+        intersection, so each pair is found exactly once.
+        """
+        if self.engine == 'numba':
+            kernels = _get_numba_kernels()
+            return kernels['grid_pairs'](
+                start, end,
+                self.ent_obj, self.ent_cell, self.ent_first, self.ent_count,
+                self.l, self.r, self.b, self.t,
+                self.xmin, self.ymin, self.cell_size, self.nx,
+            )
+
+        count = self.ent_count[start:end]
+        first = self.ent_first[start:end]
+
+        ient = np.repeat(np.arange(start, end), count)
+        offsets = np.zeros(count.size, dtype='i8')
+        offsets[1:] = count.cumsum()[:-1]
+        k = np.arange(ient.size) - offsets[ient-start]
+        jent = np.repeat(first, count) + k
+
+        ind1 = self.ent_obj[ient]
+        ind2 = self.ent_obj[jent]
+
+        l, r, b, t = self.l, self.r, self.b, self.t
+        w, = np.where(
+            (ind1 != ind2)
+            &
+            (l[ind1] < r[ind2])
+            &
+            (r[ind1] > l[ind2])
+            &
+            (t[ind1] > b[ind2])
+            &
+            (b[ind1] < t[ind2])
+        )
+        ind1 = ind1[w]
+        ind2 = ind2[w]
+        ient = ient[w]
+
+        xcorner = np.maximum(l[ind1], l[ind2])
+        ycorner = np.maximum(b[ind1], b[ind2])
+        ix, iy = self._get_cell(xcorner, ycorner)
+
+        w, = np.where( iy*self.nx + ix == self.ent_cell[ient] )
+        return ind1[w], ind2[w]
+
+
+def _get_engine(conf):
+    """
+    get the engine for the box overlap tests, falling back to numpy
+    if numba is requested but not available
+    """
+    engine = conf.get('engine','numpy')
+    if engine not in ('numpy','numba'):
+        raise ValueError("bad engine '%s', should be "
+                         "'numpy' or 'numba'" % engine)
+
+    if engine == 'numba' and _get_numba_kernels() is None:
+        print('numba is not available, using the numpy engine')
+        engine = 'numpy'
+
+    return engine
+
+_numba_kernels = None
+
+def _get_numba_kernels():
+    """
+    compile the numba kernels on first use
+
+    returns
+    -------
+    kernels: dict
+        The compiled functions, or None if numba is not available
+    """
+    global _numba_kernels
+
+    if _numba_kernels is not None:
+        return _numba_kernels
+
+    try:
+        import numba
+    except ImportError:
+        return None
+
+    @numba.njit
+    def grid_pairs(start, end,
+                   ent_obj, ent_cell, ent_first, ent_count,
+                   l, r, b, t,
+                   xmin, ymin, cell_size, nx):
+        """
+        same as BoxGrid._get_chunk_pairs, in the same order
+        """
+        ntot = 0
+        for ient in range(start, end):
+            ntot += ent_count[ient]
+
+        ind1 = np.empty(ntot, dtype=np.int64)
+        ind2 = np.empty(ntot, dtype=np.int64)
+
+        n = 0
+        for ient in range(start, end):
+            i = ent_obj[ient]
+            first = ent_first[ient]
+            for jent in range(first, first+ent_count[ient]):
+                j = ent_obj[jent]
+                if i == j:
+                    continue
+
+                if (l[i] < r[j] and r[i] > l[j]
+                        and t[i] > b[j] and b[i] < t[j]):
+
+                    xcorner = max(l[i], l[j])
+                    ycorner = max(b[i], b[j])
+                    ix = np.int64(np.floor((xcorner - xmin)/cell_size))
+                    iy = np.int64(np.floor((ycorner - ymin)/cell_size))
+
+                    if iy*nx + ix == ent_cell[ient]:
+                        ind1[n] = i
+                        ind2[n] = j
+                        n += 1
+
+        return ind1[:n], ind2[:n]
+
+    @numba.njit
+    def brute_pairs(rows, good, l, r, b, t):
+        """
+        test the boxes of the rows against all boxes with good
+        stamps
+        """
+        nobj = l.size
+
+        # count first so the outputs can be allocated once
+        n = 0
+        for i in rows:
+            for j in range(nobj):
+                if (j != i and good[j]
+                        and l[i] < r[j] and r[i] > l[j]
+                        and t[i] > b[j] and b[i] < t[j]):
+                    n += 1
+
+        ind1 = np.empty(n, dtype=np.int64)
+        ind2 = np.empty(n, dtype=np.int64)
+
+        n = 0
+        for i in rows:
+            for j in range(nobj):
+                if (j != i and good[j]
+                        and l[i] < r[j] and r[i] > l[j]
+                        and t[i] > b[j] and b[i] < t[j]):
+                    ind1[n] = i
+                    ind2[n] = j
+                    n += 1
+
+        return ind1, ind2
+
+    _numba_kernels = {
+        'grid_pairs':grid_pairs,
+        'brute_pairs':brute_pairs,
+    }
+    return _numba_kernels
+
+_pool_grid = None
+
+def _init_pool_grid(state):
+    """
+    initialize the grid used by a pool worker
+    """
+    global _pool_grid
+    _pool_grid = BoxGrid._from_shared_state(state)
+
+def _get_pool_grid_pairs(chunk):
+    """
+    get the pairs for a chunk of entries in a pool worker
+    """
+    start, end = chunk
+    return _pool_grid._get_chunk_pairs(start, end)
+
+def _to_shared(arr):
+    """
+    copy the array into shared memory
+    """
+    arr = np.ascontiguousarray(arr)
+    raw = multiprocessing.RawArray('b', max(arr.nbytes,1))
+    shared = np.frombuffer(raw, dtype=arr.dtype, count=arr.size)
+    shared[:] = arr
+    return raw, arr.dtype.str, arr.size
+
+def _from_shared(state):
+    """
+    get a view of the array in shared memory
+    """
+    raw, dtype, size = state
+    return np.frombuffer(raw, dtype=dtype, count=size)
+
+def _unique_pairs(ind1, ind2, nobj, weight=None):
+    """
+    remove duplicate pairs; the pairs are returned sorted
+
+    If weights are sent, the largest weight of the duplicates
+    is kept and returned with the pairs
+    """
+    keys = ind1*nobj + ind2
+    if weight is None:
+        keys = np.unique(keys)
+        return keys // nobj, keys % nobj
+
+    s = np.lexsort( (-weight, keys) )
+    keys = keys[s]
+    weight = weight[s]
+
+    keys, first = np.unique(keys, return_index=True)
+    return keys // nobj, keys % nobj, weight[first]
+
+def _nbrs_data_to_pairs(nbrs_data):
+    """
+    convert the nbrs table to pairs of indices
+    """
+    w, = np.where(nbrs_data['nbr_number'] > 0)
+    return nbrs_data['number'][w]-1, nbrs_data['nbr_number'][w]-1
+
+def nbrs_to_csr(nbrs_data, nobj):
+    """
+    convert the nbrs table to the compact CSR format
+
+    parameters
+    ----------
+    nbrs_data: array
+        The nbrs table
+    nobj: int
+        The number of objects; objects are numbered 1..nobj
+
+    returns
+    -------
+    offsets, nbr_list: arrays
+        The nbrs of object number n are nbr_list[offsets[n-1]:offsets[n]].
+        nbr_list has fields nbr_number and weight.  There are no
+        entries for objects without nbrs.
+    """
+    w, = np.where(nbrs_data['nbr_number'] > 0)
+    number = nbrs_data['number'][w]
+
+    s = number.argsort(kind='mergesort')
+    number = number[s]
+    w = w[s]
+
+    nbr_list = np.zeros(w.size, dtype=[('nbr_number','i8'),('weight','f4')])
+    nbr_list['nbr_number'] = nbrs_data['nbr_number'][w]
+    if 'weight' in nbrs_data.dtype.names:
+        nbr_list['weight'] = nbrs_data['weight'][w]
+
+    offsets = np.searchsorted(
+        number,
+        np.arange(1, nobj+2),
+    ).astype('i8')
+    return offsets, nbr_list
+
+def csr_to_nbrs(offsets, nbr_list):
+    """
+    convert the compact CSR format back to the nbrs table
+
+    parameters
+    ----------
+    offsets, nbr_list: arrays
+        As returned by nbrs_to_csr
+
+    returns
+    -------
+    nbrs_data: array
+        The nbrs table
+    """
+    nobj = offsets.size-1
+    ind1 = np.repeat(np.arange(nobj), np.diff(offsets))
+    ind2 = nbr_list['nbr_number']-1
+
+    return _pairs_to_nbrs_data(
+        np.arange(1, nobj+1),
+        ind1,
+        ind2,
+        nbr_list['weight'],
+    )
+
+def _get_nbrs_csr(nbrs_data, nobj):
+    """
+    convert the nbrs table to a CSR adjacency; the nbrs of object
+    index i are adj[offsets[i]:offsets[i+1]]
+    """
+    offsets, nbr_list = nbrs_to_csr(nbrs_data, nobj)
+    return offsets, nbr_list['nbr_number']-1
+
+def _pairs_to_nbrs_data(number, ind1, ind2, weight):
+    """
+    convert pairs of indices to the nbrs table
+
+    Objects without nbrs get a single entry with nbr_number -1 and
+    weight 0.  The table is sorted by number then nbr_number
+    """
+    dtype = [('number','i8'),('nbr_number','i8'),('weight','f4')]
+
+    has_nbrs = np.zeros(number.size, dtype=bool)
+    has_nbrs[ind1] = True
+    lone, = np.where(~has_nbrs)
+
+    nbrs_data = np.zeros(ind1.size + lone.size, dtype=dtype)
+    nbrs_data['number'][:ind1.size] = number[ind1]
+    nbrs_data['nbr_number'][:ind1.size] = number[ind2]
+    nbrs_data['weight'][:ind1.size] = weight
+    nbrs_data['number'][ind1.size:] = number[lone]
+    nbrs_data['nbr_number'][ind1.size:] = -1
+
+    s = np.lexsort( (nbrs_data['nbr_number'], nbrs_data['number']) )
+    return nbrs_data[s]
+
+
 class NbrsFoF(object):
+    """
+    link objects into FoF groups using the nbrs table
+
+    The nbrs table is converted once to a compressed sparse row (CSR)
+    adjacency, and the groups are found with a disjoint set using
+    path compression and union by rank.
+
+    parameters
+    ----------
+    nbrs_data: array
+        nbrs table with fields number and nbr_number; objects are
+        numbered 1..N and objects without nbrs have nbr_number -1
+    """
     def __init__(self,nbrs_data):
         self.nbrs_data = nbrs_data
         self.Nobj = len(np.unique(nbrs_data['number']))
 
         #records fofid of entry
         self.linked = np.zeros(self.Nobj,dtype='i8')
-        self.fofs = {}
 
         self._fof_data = None
 
@@ -219,65 +1603,652 @@ class NbrsFoF(object):
         return self._fof_data
 
     def _make_fofs(self,verbose=True):
-        #init
-        self._init_fofs()
+        self._make_csr()
 
+        dset = DisjointSet(self.Nobj)
 
-        for i in prange(self.Nobj):
-            self._link_fof(i)
+        if verbose:
+            rng = prange(self.Nobj)
+        else:
+            rng = range(self.Nobj)
+
+        offsets = self.offsets
+        adj = self.adj
+        for i in rng:
+            for j in adj[offsets[i]:offsets[i+1]]:
+                if j > i:
+                    dset.union(i, j)
 
-        for fofid,k in enumerate(self.fofs):
-            inds = np.array(list(self.fofs[k]),dtype=int)
-            self.linked[inds[:]] = fofid
-        self.fofs = {}
+        self.linked[:] = dset.get_labels()
 
         self._make_fof_data()
 
-    def _link_fof(self,mind):
-        #get nbrs for this object
-        nbrs = set(self._get_nbrs_index(mind))
-
-        #always make a base fof
-        if self.linked[mind] == -1:
-            fofid = copy.copy(mind)
-            self.fofs[fofid] = set([mind])
-            self.linked[mind] = fofid
-        else:
-            fofid = copy.copy(self.linked[mind])
-
-        #loop through nbrs
-        for nbr in nbrs:
-            if self.linked[nbr] == -1 or self.linked[nbr] == fofid:
-                #not linked so add to current
-                self.fofs[fofid].add(nbr)
-                self.linked[nbr] = fofid
-            else:
-                #join!
-                self.fofs[self.linked[nbr]] |= self.fofs[fofid]
-                del self.fofs[fofid]
-                fofid = copy.copy(self.linked[nbr])
-                inds = np.array(list(self.fofs[fofid]),dtype=int)
-                self.linked[inds[:]] = fofid
+    def _make_csr(self):
+        """
+        build the CSR adjacency from the nbrs table; the nbrs of object
+        index i are adj[offsets[i]:offsets[i+1]]
+        """
+        self.offsets, self.adj = _get_nbrs_csr(self.nbrs_data, self.Nobj)
 
     def _make_fof_data(self):
-        self._fof_data = []
-        for i in range(self.Nobj):
-            self._fof_data.append((self.linked[i],i+1))
-        self._fof_data = np.array(self._fof_data,dtype=[('fofid','i8'),('number','i8')])
-        i = np.argsort(self._fof_data['number'])
-        self._fof_data = self._fof_data[i]
+        self._fof_data = np.zeros(
+            self.Nobj,
+            dtype=[('fofid','i8'),('number','i8')],
+        )
+        self._fof_data['fofid'] = self.linked
+        self._fof_data['number'] = np.arange(1, self.Nobj+1)
         assert np.all(self._fof_data['fofid'] >= 0)
 
-    def _init_fofs(self):
-        self.linked[:] = -1
-        self.fofs = {}
-
     def _get_nbrs_index(self,mind):
-        q, = np.where((self.nbrs_data['number'] == mind+1) & (self.nbrs_data['nbr_number'] > 0))
-        if len(q) > 0:
-            return list(self.nbrs_data['nbr_number'][q]-1)
+        return list(self.adj[self.offsets[mind]:self.offsets[mind+1]])
+
+
+class FoFSplitter(object):
+    """
+    split FoF groups larger than max_fof_size using graph cuts on
+    the nbrs graph
+
+    The MOF cost grows faster than linearly with the group size, so a
+    few percolated groups can dominate the run time.  Each large group
+    is split into its connected pieces, or if it is connected, bisected
+    at the median of the Fiedler vector of its graph Laplacian (a
+    spectral cut).  This is repeated until no piece is larger than
+    max_fof_size.
+
+    The new fofids are contiguous and ordered by the original fofid,
+    which is kept in the parent_fofid column.  The links that were cut
+    are recorded, in the same format as the nbrs table, and written to
+    the fof_cuts extension.  When fitting a piece, the Processor adds
+    the nbrs on the other side of its cuts to the fit, so they are
+    modeled, but only outputs the members of the piece.
+
+    The Laplacian is stored as a sparse matrix and the Fiedler vector is
+    found with scipy.sparse.linalg.eigsh in shift-invert mode, using a
+    sparse LU decomposition, rather than a dense n^3 eigen solve.
+
+    parameters
+    ----------
+    nbrs_data: array
+        The nbrs table
+    fofs: array
+        The fofs table, as returned by get_fofs
+    max_fof_size: int
+        The maximum number of objects in a group
+    """
+    def __init__(self, nbrs_data, fofs, max_fof_size):
+        assert max_fof_size > 1,'max_fof_size must be at least 2'
+
+        self.nbrs_data = nbrs_data
+        self.fofs = fofs
+        self.max_fof_size = max_fof_size
+
+    def go(self):
+        """
+        split the large groups
+
+        returns
+        -------
+        fofs, cuts: arrays
+            The fofs table with the new fofid and a parent_fofid
+            column, and the links that were cut in the nbrs table
+            format
+        """
+        fofs = self.fofs
+        nobj = fofs.size
+
+        self.offsets, self.adj = _get_nbrs_csr(self.nbrs_data, nobj)
+
+        # fofids indexed by number-1
+        parent = np.zeros(nobj, dtype='i8')
+        parent[fofs['number']-1] = fofs['fofid']
+
+        # index of the piece within the parent group, 0 for groups
+        # that are not split
+        sub = np.zeros(nobj, dtype='i8')
+
+        sizes = np.bincount(parent)
+        big, = np.where(sizes > self.max_fof_size)
+        print('splitting %d groups larger than %d' % (big.size,self.max_fof_size))
+
+        if big.size > 0:
+            s = parent.argsort(kind='mergesort')
+            starts = np.searchsorted(parent[s], big)
+            for fofid, start in zip(big, starts):
+                members = s[start:start+sizes[fofid]]
+                for isub, piece in enumerate(self._split(members)):
+                    sub[piece] = isub
+
+        keys = parent*nobj + sub
+        ukeys, inverse = np.unique(keys, return_inverse=True)
+        fofid = inverse.ravel()
+
+        new_fofs = np.zeros(
+            nobj,
+            dtype=[('fofid','i8'),('number','i8'),('parent_fofid','i8')],
+        )
+        new_fofs['number'] = np.arange(1, nobj+1)
+        new_fofs['fofid'] = fofid
+        new_fofs['parent_fofid'] = parent
+
+        cuts = self._get_cuts(fofid)
+        print('groups: %d -> %d' % (sizes.size, ukeys.size))
+        print('cut links: %d' % (cuts.size//2))
+
+        return new_fofs, cuts
+
+    def _split(self, members):
+        """
+        split the group into pieces no larger than max_fof_size
+        """
+        pieces=[]
+        todo=[members]
+        while len(todo) > 0:
+            part = todo.pop()
+            if part.size <= self.max_fof_size:
+                pieces.append(part)
+                continue
+
+            ind1, ind2 = self._get_local_pairs(part)
+
+            parts = self._get_components(part, ind1, ind2)
+            if len(parts) == 1:
+                parts = self._bisect(part, ind1, ind2)
+
+            todo += parts
+
+        return pieces
+
+    def _get_local_pairs(self, part):
+        """
+        get the links between members of the part, as indices into
+        the part
+        """
+        offsets = self.offsets
+
+        local = {}
+        for i, index in enumerate(part):
+            local[index] = i
+
+        ind1=[]
+        ind2=[]
+        for i, index in enumerate(part):
+            for j in self.adj[offsets[index]:offsets[index+1]]:
+                if j in local:
+                    ind1.append(i)
+                    ind2.append(local[j])
+
+        return np.array(ind1, dtype='i8'), np.array(ind2, dtype='i8')
+
+    def _get_components(self, part, ind1, ind2):
+        """
+        get the connected pieces of the part
+        """
+        dset = DisjointSet(part.size)
+        for i, j in zip(ind1, ind2):
+            dset.union(i, j)
+
+        labels = dset.get_labels()
+        return [part[labels == label] for label in range(labels.max()+1)]
+
+    def _bisect(self, part, ind1, ind2):
+        """
+        split a connected part in two at the median of the Fiedler
+        vector of the graph Laplacian
+        """
+        import scipy.sparse
+        import scipy.sparse.csgraph
+        import scipy.sparse.linalg
+
+        n = part.size
+
+        # symmetric adjacency with unit weights, even if a link is
+        # listed once or more than once
+        adj = scipy.sparse.coo_matrix(
+            (np.ones(ind1.size), (ind1, ind2)),
+            shape=(n, n),
+        ).tocsr()
+        adj = adj + adj.T
+        adj.data[:] = 1.0
+
+        lap = scipy.sparse.csgraph.laplacian(adj).tocsc()
+
+        # the Laplacian is singular, so use a small negative shift to
+        # get the two smallest eigenvalues.  The shift must be small
+        # compared to the second eigenvalue, which is ~1/n^2 for long
+        # chains, or the convergence is slow.  The fixed start vector
+        # keeps the result reproducible
+        v0 = np.random.RandomState(n).uniform(size=n)
+        evals, evecs = scipy.sparse.linalg.eigsh(
+            lap,
+            k=2,
+            sigma=-1.0e-8,
+            which='LM',
+            v0=v0,
+        )
+        fiedler = evecs[:,evals.argsort()[1]]
+
+        # sort so the two halves have equal size even for ties
+        s = fiedler.argsort(kind='mergesort')
+        half = n//2
+        return [part[s[:half]], part[s[half:]]]
+
+    def _get_cuts(self, fofid):
+        """
+        get the links between objects that are now in different groups
+        """
+        nbrs_data = self.nbrs_data
+
+        w, = np.where(nbrs_data['nbr_number'] > 0)
+        number = nbrs_data['number'][w]
+        nbr_number = nbrs_data['nbr_number'][w]
+        if 'weight' in nbrs_data.dtype.names:
+            weight = nbrs_data['weight'][w]
+
+        w, = np.where(fofid[number-1] != fofid[nbr_number-1])
+
+        cuts = np.zeros(w.size, dtype=nbrs_data.dtype)
+        cuts['number'] = number[w]
+        cuts['nbr_number'] = nbr_number[w]
+        if 'weight' in nbrs_data.dtype.names:
+            cuts['weight'] = weight[w]
+        return cuts
+
+
+class DisjointSet(object):
+    """
+    array based disjoint set (union-find) with path compression
+    and union by rank
+
+    parameters
+    ----------
+    num: int
+        number of elements
+    """
+    def __init__(self, num):
+        self.parent = np.arange(num, dtype='i8')
+        self.rank = np.zeros(num, dtype='i1')
+
+    def find(self, i):
+        """
+        find the root of the set holding element i, compressing
+        the path along the way
+        """
+        parent = self.parent
+
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+
+        while parent[i] != root:
+            inext = parent[i]
+            parent[i] = root
+            i = inext
+
+        return root
+
+    def union(self, i, j):
+        """
+        merge the sets holding elements i and j
+        """
+        iroot = self.find(i)
+        jroot = self.find(j)
+        if iroot == jroot:
+            return
+
+        rank = self.rank
+        if rank[iroot] < rank[jroot]:
+            iroot, jroot = jroot, iroot
+
+        self.parent[jroot] = iroot
+        if rank[iroot] == rank[jroot]:
+            rank[iroot] += 1
+
+    def get_labels(self):
+        """
+        get a contiguous set id for each element
+
+        Ids are assigned in order of the first element of each set,
+        so the result does not depend on the order of the unions
+        """
+        roots = self.parent.copy()
+        while True:
+            next_roots = roots[roots]
+            if np.all(next_roots == roots):
+                break
+            roots = next_roots
+
+        uroots, first, inverse = np.unique(
+            roots,
+            return_index=True,
+            return_inverse=True,
+        )
+        ids = np.zeros(uroots.size, dtype='i8')
+        ids[first.argsort()] = np.arange(uroots.size)
+        return ids[inverse.ravel()]
+
+def sort_fofs(fofs):
+    """
+    sort the fofs table by fofid and get the index of the groups
+
+    parameters
+    ----------
+    fofs: array
+        The fofs table
+
+    returns
+    -------
+    fofs, fof_index: arrays
+        The fofs table sorted by fofid then number, and a table with
+        one row per fofid holding the first row of the group in the
+        sorted table and the number of members.  The members of a
+        group are fofs[start:start+length]
+    """
+    s = np.lexsort( (fofs['number'], fofs['fofid']) )
+    fofs = fofs[s]
+
+    nfofs = fofs['fofid'].max()+1
+    fof_index = np.zeros(
+        nfofs,
+        dtype=[('fofid','i8'),('start','i8'),('length','i8')],
+    )
+    fof_index['fofid'] = np.arange(nfofs)
+    fof_index['length'] = np.bincount(fofs['fofid'], minlength=nfofs)
+    fof_index['start'][1:] = fof_index['length'].cumsum()[:-1]
+
+    return fofs, fof_index
+
+def get_tile_owned(cat, name, nbr_cats, nbr_names, match_radius=1.0):
+    """
+    find the objects owned by this tile when neighboring tiles overlap
+
+    Objects in this tile are matched to the objects in each neighboring
+    tile.  A matched object is owned by the tile whose center is nearest
+    to the mean position of all copies of the object; ties go to the
+    tile with the lowest name.  As long as each tile is sent all of the
+    tiles it overlaps, the rule gives the same answer in each tile, so
+    each object is owned by exactly one tile.  Objects without a match
+    are owned.
+
+    The tile centers are the centers of the ra,dec ranges of the
+    catalogs.
+
+    parameters
+    ----------
+    cat: array
+        The catalog for this tile, with ra and dec
+    name: string
+        Name of this tile, e.g. the MEDS file name
+    nbr_cats: list of arrays
+        The catalogs of the neighboring tiles
+    nbr_names: list of strings
+        Names of the neighboring tiles
+    match_radius: float, optional
+        Match radius in arcsec, default 1
+
+    returns
+    -------
+    owned: array
+        bool array, True for objects owned by this tile
+    """
+    ra_sum = cat['ra'].astype('f8')
+    dec_sum = cat['dec'].astype('f8')
+    ncopy = np.ones(cat.size)
+
+    matched_list=[]
+    for nbr_cat in nbr_cats:
+        ind1, ind2 = _match_positions(cat, nbr_cat, match_radius)
+
+        ra_sum[ind1] += nbr_cat['ra'][ind2]
+        dec_sum[ind1] += nbr_cat['dec'][ind2]
+        ncopy[ind1] += 1
+
+        matched = np.zeros(cat.size, dtype=bool)
+        matched[ind1] = True
+        matched_list.append(matched)
+
+    ra = ra_sum/ncopy
+    dec = dec_sum/ncopy
+
+    cen = _get_tile_center(cat)
+    dist2 = _get_dist2(ra, dec, cen[0], cen[1])
+
+    owned = np.ones(cat.size, dtype=bool)
+    for nbr_cat, nbr_name, matched in zip(nbr_cats, nbr_names, matched_list):
+        nbr_cen = _get_tile_center(nbr_cat)
+        nbr_dist2 = _get_dist2(ra, dec, nbr_cen[0], nbr_cen[1])
+
+        if nbr_name < name:
+            lost = matched & (nbr_dist2 <= dist2)
         else:
-            return []
+            lost = matched & (nbr_dist2 < dist2)
+
+        owned[lost] = False
+        print('%s: %d matched, %d owned by %s' % (
+            name, matched.sum(), lost.sum(), nbr_name,
+        ))
+
+    return owned
+
+def set_fof_owned(fofs, fof_index, owned):
+    """
+    add the ownership to the fofs and the index of the groups
+
+    A group is owned, and should be fit, if any of its members is
+    owned by the tile, so that the owned objects are fit along with
+    their neighbors.  A group straddling two tiles is then fit in both,
+    so the owned flag of each object is also copied into the model_fits
+    and the objects not owned by the tile are dropped when collating.
+
+    parameters
+    ----------
+    fofs: array
+        The fofs table
+    fof_index: array
+        The index of the groups, as returned by sort_fofs
+    owned: array
+        bool array, indexed by number-1, as returned by get_tile_owned
+
+    returns
+    -------
+    fofs, fof_index: arrays
+        Copies with an owned column
+    """
+    new_fofs = _add_owned_column(fofs)
+    new_fofs['owned'] = owned[fofs['number']-1]
+
+    nowned = np.bincount(
+        fofs['fofid'],
+        weights=new_fofs['owned'],
+        minlength=fof_index.size,
+    )
+
+    new_index = _add_owned_column(fof_index)
+    new_index['owned'] = nowned > 0
+
+    print('owned groups: %d/%d' % (new_index['owned'].sum(), new_index.size))
+    return new_fofs, new_index
+
+def _add_owned_column(arr):
+    """
+    copy the array, adding an owned column
+    """
+    names = arr.dtype.names
+    descr = [(name, arr.dtype[name]) for name in names if name != 'owned']
+
+    new_arr = np.zeros(arr.size, dtype=descr + [('owned','i2')])
+    for name in new_arr.dtype.names:
+        if name in names:
+            new_arr[name] = arr[name]
+
+    return new_arr
+
+def _get_tile_center(cat):
+    """
+    center of the ra,dec range of the catalog
+    """
+    ra = 0.5*(cat['ra'].min() + cat['ra'].max())
+    dec = 0.5*(cat['dec'].min() + cat['dec'].max())
+    return ra, dec
+
+def _get_dist2(ra, dec, ra0, dec0):
+    """
+    squared distance in the tangent plane, in square degrees
+    """
+    dra = (ra - ra0)*np.cos(np.radians(dec0))
+    ddec = dec - dec0
+    return dra**2 + ddec**2
+
+def _match_positions(cat1, cat2, match_radius):
+    """
+    match two catalogs within the radius in arcsec, using a BoxGrid
+
+    returns
+    -------
+    ind1, ind2: arrays
+        Indices of the matched pairs into cat1 and cat2, with only the
+        nearest match kept for each object in cat1
+    """
+    n1 = cat1.size
+    ra = np.concatenate( [cat1['ra'], cat2['ra']] )
+    dec = np.concatenate( [cat1['dec'], cat2['dec']] )
+
+    dec0 = np.median(dec)
+    cosdec = np.cos(np.radians(dec0))
+    x = (ra - np.median(ra))*3600.0*cosdec
+    y = (dec - dec0)*3600.0
+
+    grid = BoxGrid(
+        x - match_radius, x + match_radius,
+        y - match_radius, y + match_radius,
+        2*match_radius,
+    )
+    ind1, ind2 = grid.get_pairs()
+
+    # pairs are found in both orders; keep one order across catalogs
+    w, = np.where( (ind1 < n1) & (ind2 >= n1) )
+    ind1 = ind1[w]
+    ind2 = ind2[w]
+
+    dist2 = (x[ind1]-x[ind2])**2 + (y[ind1]-y[ind2])**2
+    w, = np.where(dist2 < match_radius**2)
+    ind1 = ind1[w]
+    ind2 = ind2[w]
+    dist2 = dist2[w]
+
+    # keep the nearest match for each object in cat1
+    s = np.lexsort( (dist2, ind1) )
+    ind1 = ind1[s]
+    ind2 = ind2[s]
+    ind1, first = np.unique(ind1, return_index=True)
+
+    return ind1, ind2[first]-n1
+
+def get_fof_stats(fofs, meds_list):
+    """
+    get the size and predicted fit cost of each FoF group
+
+    The MOF fitter renders every object in the group on the stamps of
+    all members, so the predicted cost is the number of members times
+    the total number of stamp pixels, summed over bands.  Only the
+    relative values are meaningful.
+
+    parameters
+    ----------
+    fofs: array
+        The fofs table
+    meds_list: list of MEDS
+        The MEDS objects for each band, or anything with the same
+        catalog columns
+
+    returns
+    -------
+    stats: array
+        One row per fofid with the number of members, the stamp pixels
+        and number of epochs for each band, and the predicted cost
+    """
+    nfofs = fofs['fofid'].max()+1
+    nband = len(meds_list)
+
+    fofid = fofs['fofid']
+    indices = fofs['number']-1
+
+    stats = np.zeros(
+        nfofs,
+        dtype=[
+            ('fofid','i8'),
+            ('nmember','i4'),
+            ('npix','i8',(nband,)),
+            ('nepoch','i4',(nband,)),
+            ('cost','f8'),
+        ],
+    )
+    stats['fofid'] = np.arange(nfofs)
+    stats['nmember'] = np.bincount(fofid, minlength=nfofs)
+
+    for band, m in enumerate(meds_list):
+        ncutout = m['ncutout'][indices].astype('i8')
+        box_size = m['box_size'][indices].astype('i8')
+
+        stats['npix'][:,band] = np.bincount(
+            fofid,
+            weights=ncutout*box_size**2,
+            minlength=nfofs,
+        )
+        stats['nepoch'][:,band] = np.bincount(
+            fofid,
+            weights=ncutout,
+            minlength=nfofs,
+        )
+
+    stats['cost'] = stats['nmember']*stats['npix'].sum(axis=1)
+
+    return stats
+
+def print_fof_stats(stats, ntop=10):
+    """
+    print a summary of the FoF stats: the size histogram, the most
+    expensive groups and the total predicted cost
+
+    parameters
+    ----------
+    stats: array
+        As returned by get_fof_stats
+    ntop: int, optional
+        Number of the most expensive groups to show, default 10
+    """
+    total = stats['cost'].sum()
+    if total <= 0:
+        total = 1.0
+
+    print('groups: %d  objects: %d' % (stats.size, stats['nmember'].sum()))
+    print('total predicted cost: %g' % stats['cost'].sum())
+
+    print()
+    print('%12s %8s %8s' % ('size','ngroup','costfrac'))
+
+    # bins in powers of two
+    nmember = stats['nmember']
+    low = 1
+    while low <= nmember.max():
+        high = 2*low-1
+        w, = np.where( (nmember >= low) & (nmember <= high) )
+        if w.size > 0:
+            if low == high:
+                rng = '%d' % low
+            else:
+                rng = '%d-%d' % (low, high)
+            frac = stats['cost'][w].sum()/total
+            print('%12s %8d %8.4f' % (rng, w.size, frac))
+        low *= 2
+
+    print()
+    print('most expensive groups')
+    print('%8s %8s %12s %8s' % ('fofid','nmember','cost','costfrac'))
+    s = stats['cost'].argsort()[::-1][:ntop]
+    for st in stats[s]:
+        print('%8d %8d %12g %8.4f' % (
+            st['fofid'], st['nmember'], st['cost'], st['cost']/total,
+        ))
 
 def plot_fofs(m,
               fof,
@@ -288,11 +2259,20 @@ def plot_fofs(m,
               minsize=2,
               show=False,
               width=1000,
-              plotfile=None):
+              plotfile=None,
+              raster=False,
+              nbin=None):
     """
     make an ra,dec plot of the FOF groups
 
     Only groups with at least two members ares shown
+
+    If raster is True, the objects are binned into an image with nbin
+    bins along ra, default width/2, rather than drawn as points.  Bins
+    holding members of groups with at least minsize members are colored
+    by the size of the largest group in the bin, others are shaded by
+    the number of objects.  The time does not depend on the number of
+    groups, so this is much faster for large catalogs.
     """
     import random
     try:
@@ -310,6 +2290,13 @@ def plot_fofs(m,
     x = m['ra']
     y = m['dec']
 
+    if raster:
+        if nbin is None:
+            nbin = width//2
+        plt, aratio = _get_fofs_raster_plot(x, y, fof, minsize, nbin)
+        _write_fofs_plot(plt, width, aratio, plotfile, show)
+        return
+
     hd=eu.stat.histogram(fof['fofid'], more=True)
     wlarge,=np.where(hd['hist'] >= minsize)
     ngroup=wlarge.size
@@ -371,6 +2358,12 @@ def plot_fofs(m,
                 plt.add(pts)
                 icolor += 1
 
+    _write_fofs_plot(plt, width, aratio, plotfile, show)
+
+def _write_fofs_plot(plt, width, aratio, plotfile, show):
+    """
+    write and/or show the FoF plot
+    """
     height=int(width*aratio)
     if plotfile is not None:
         ffront=os.path.basename(plotfile)
@@ -383,6 +2376,76 @@ def plot_fofs(m,
     if show:
         plt.show(width=width, height=height)
 
+def _get_fofs_raster_plot(x, y, fof, minsize, nbin):
+    """
+    bin the objects into an rgb image, with bins holding group members
+    colored by group size
+    """
+    import biggles
+
+    xmin, xmax = x.min(), x.max()
+    ymin, ymax = y.min(), y.max()
+    xrng = max(xmax-xmin, 1.0e-10)
+    yrng = max(ymax-ymin, 1.0e-10)
+    aratio = yrng/xrng
+
+    nx = nbin
+    ny = max(int(nbin*aratio), 1)
+
+    ix = ((x - xmin)/xrng*nx).astype('i8').clip(max=nx-1)
+    iy = ((y - ymin)/yrng*ny).astype('i8').clip(max=ny-1)
+    pix = ix*ny + iy
+
+    # size of the group for each object, indexed by number-1
+    sizes = np.bincount(fof['fofid'])
+    objsize = np.zeros(x.size, dtype='i8')
+    objsize[fof['number']-1] = sizes[fof['fofid']]
+
+    count = np.bincount(pix, minlength=nx*ny)
+
+    maxsize = np.zeros(nx*ny, dtype='i8')
+    w, = np.where(objsize >= minsize)
+    np.maximum.at(maxsize, pix[w], objsize[w])
+
+    print("unique groups >= %d:" % minsize, (sizes >= minsize).sum())
+    print("largest fof:",sizes.max())
+
+    # white background, gray for isolated objects
+    im = np.ones( (nx*ny, 3) )
+    if count.max() > 0:
+        gray = 1.0 - 0.5*np.log1p(count)/np.log1p(count.max())
+        im *= gray[:,np.newaxis]
+
+    # colors from the rainbow, on a log scale of the group size
+    w, = np.where(maxsize > 0)
+    if w.size > 0:
+        ncolors = 256
+        colors = np.array(rainbow(ncolors, type='rgb'))/255.0
+
+        lmin = np.log(minsize)
+        lmax = np.log(maxsize.max())
+        if lmax > lmin:
+            frac = (np.log(maxsize[w]) - lmin)/(lmax - lmin)
+        else:
+            frac = np.zeros(w.size)
+        icolor = (frac*(ncolors-1)).astype('i8')
+        im[w] = colors[icolor]
+
+    im = im.reshape(nx, ny, 3)
+
+    plt=biggles.FramedPlot(
+        xlabel='RA',
+        ylabel='DEC',
+        xrange=[xmin, xmax],
+        yrange=[ymin, ymax],
+        aspect_ratio=aratio,
+    )
+    plt.add(
+        biggles.Density(im, ((xmin, ymin), (xmax, ymax)))
+    )
+
+    return plt, aratio
+
 def rainbow(num, type='hex'):
     """
     make rainbow colors
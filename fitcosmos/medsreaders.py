@@ -0,0 +1,366 @@
+"""
+MEDS readers with bulk reading of cutouts
+"""
+import logging
+import numpy as np
+import ngmix.medsreaders
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TYPES = ('image', 'weight', 'bmask', 'psf')
+
+# extensions holding the flat cutout arrays, keyed by cutout type
+CUTOUT_EXTENSIONS = {
+    'image':'image_cutouts',
+    'weight':'weight_cutouts',
+    'bmask':'bmask_cutouts',
+    'seg':'seg_cutouts',
+    'psf':'psf',
+}
+
+# big endian dtypes for FITS BITPIX values
+BITPIX_DTYPES = {
+    8:'u1',
+    16:'>i2',
+    32:'>i4',
+    64:'>i8',
+    -32:'>f4',
+    -64:'>f8',
+}
+
+class BulkNGMixMEDS(ngmix.medsreaders.NGMixMEDS):
+    """
+    NGMixMEDS that can read the cutouts for a set of objects in bulk
+
+    Reading an object cutout by cutout does several small reads at
+    scattered places in the file.  read_cutouts gathers the cutouts for
+    all requested objects, sorts them by start_row and reads runs of
+    nearby cutouts with a single read.  get_cutout and get_psf return
+    the cached pixels, so get_obs and get_mbobs give the same
+    observations as without the cache.
+
+    Each cached cutout is returned only once, later requests for the
+    same cutout read it from the file again, as the caller may modify
+    the returned array in place.
+
+    With mmap=True the cutout extensions are memory mapped, and
+    get_cutout and get_psf return read only views into the map rather
+    than reading the pixels.  Processes reading the same file then
+    share the page cache, and the many small read calls are avoided.
+    This does not save memory in the fit: the FITS pixels are big
+    endian, so ngmix copies them to native f8 when the Observation is
+    made in get_obs.  Compressed or scaled extensions cannot be mapped
+    and are read as usual.
+
+    Windows can be sent to read_cutouts to read only part of a cutout,
+    e.g. when the stamps are to be trimmed.  For a cutout with a window,
+    only the rows in the window are read, and the image, weight, bmask
+    and seg cutouts are cut to the window.  The jacobian center and
+    orig_start_row/col of the observation are shifted to match, and
+    meta['trimmed'] is set.
+
+    parameters
+    ----------
+    filename: str
+        The MEDS file
+    max_gap: int, optional
+        Cutouts separated by up to this many pixels are read together,
+        default 16384
+    mmap: bool, optional
+        If True, memory map the cutout extensions, default False
+    """
+    def __init__(self, filename, max_gap=16384, mmap=False, **kw):
+        super(BulkNGMixMEDS,self).__init__(filename, **kw)
+        self.max_gap = max_gap
+        self._cutout_cache = {}
+        self._windows = {}
+
+        self._mmaps = {}
+        if mmap:
+            self._set_mmaps(filename)
+
+    def read_cutouts(self, indices, types=DEFAULT_TYPES, windows=None):
+        """
+        read all cutouts for the objects into the cache, replacing
+        what was there
+
+        parameters
+        ----------
+        indices: array
+            Indices of the objects
+        types: sequence, optional
+            Cutout types to read, default image, weight, bmask and psf.
+            Types not in the file are skipped
+        windows: dict, optional
+            (row_start, row_end, col_start, col_end) keyed by
+            (iobj, icutout).  Only these parts of the cutouts are read.
+            The windows are kept until the cache is cleared
+        """
+        self.clear_cache()
+        if windows is not None:
+            self._windows = windows
+
+        indices = np.atleast_1d(indices)
+        iobj, icut = self._get_cutout_list(indices)
+        if iobj.size == 0:
+            return
+
+        for type in types:
+            if type in self._mmaps:
+                # views are made on demand
+                continue
+
+            cols = None
+            if type == 'psf':
+                if 'psf' not in self._fits \
+                        or 'psf_start_row' not in self._cat.dtype.names:
+                    continue
+                extname = 'psf'
+                start_row = self._cat['psf_start_row'][iobj, icut]
+                shapes = self._get_psf_shapes(iobj, icut)
+            else:
+                extname = '%s_cutouts' % type
+                if extname not in self._fits:
+                    continue
+                start_row = self._cat['start_row'][iobj, icut]
+                box_size = self._cat['box_size'][iobj]
+                start_row, shapes, cols = self._get_read_windows(
+                    iobj,
+                    icut,
+                    start_row,
+                    box_size,
+                )
+
+            self._read_ext(
+                extname,
+                type,
+                iobj,
+                icut,
+                start_row,
+                shapes,
+                cols=cols,
+            )
+
+    def clear_cache(self):
+        """
+        remove all cutouts and windows from the cache
+        """
+        self._cutout_cache = {}
+        self._windows = {}
+
+    def get_obs(self, iobj, icutout, **kw):
+        """
+        get an observation, shifting the jacobian center and the
+        orig_start_row/col if the cutout has a window
+        """
+        obs = super(BulkNGMixMEDS,self).get_obs(iobj, icutout, **kw)
+
+        window = self._windows.get((iobj, icutout))
+        if window is not None:
+            row_start, row_end, col_start, col_end = window
+
+            jac = obs.jacobian
+            cen = jac.get_cen()
+            jac.set_cen(row=cen[0] - row_start, col=cen[1] - col_start)
+            obs.set_jacobian(jac)
+
+            obs.meta['orig_start_row'] += row_start
+            obs.meta['orig_start_col'] += col_start
+            obs.meta['trimmed'] = True
+
+        return obs
+
+    def get_cutout(self, iobj, icutout, type='image'):
+        """
+        get a cutout, from the cache or the memory map if present
+        """
+        key = (type, iobj, icutout)
+        if key in self._cutout_cache:
+            return self._cutout_cache.pop(key)
+
+        if type == 'psf':
+            return self.get_psf(iobj, icutout)
+
+        start_row = self._cat['start_row'][iobj, icutout]
+        if type in self._mmaps and start_row >= 0:
+            box_size = self._cat['box_size'][iobj]
+            im = self._get_view(type, start_row, (box_size, box_size))
+        else:
+            im = super(BulkNGMixMEDS,self).get_cutout(
+                iobj,
+                icutout,
+                type=type,
+            )
+
+        window = self._windows.get((iobj, icutout))
+        if window is not None:
+            row_start, row_end, col_start, col_end = window
+            im = im[row_start:row_end, col_start:col_end]
+
+        return im
+
+    def get_psf(self, iobj, icutout):
+        """
+        get the psf image, from the cache or the memory map if present
+        """
+        key = ('psf', iobj, icutout)
+        if key in self._cutout_cache:
+            return self._cutout_cache.pop(key)
+
+        if 'psf' in self._mmaps:
+            start_row = self._cat['psf_start_row'][iobj, icutout]
+            if start_row >= 0:
+                shape = self._get_psf_shapes(
+                    np.atleast_1d(iobj),
+                    np.atleast_1d(icutout),
+                )[0]
+                return self._get_view('psf', start_row, tuple(shape))
+
+        return super(BulkNGMixMEDS,self).get_psf(iobj, icutout)
+
+    def _set_mmaps(self, filename):
+        """
+        memory map the cutout extensions that are stored uncompressed
+        and unscaled
+        """
+        for type, extname in CUTOUT_EXTENSIONS.items():
+            if extname not in self._fits:
+                continue
+
+            if type == 'psf' and 'psf_start_row' not in self._cat.dtype.names:
+                continue
+
+            hdu = self._fits[extname]
+            info = hdu.get_info()
+            dtype = BITPIX_DTYPES.get(info['img_type'])
+
+            if (hdu.is_compressed()
+                    or info['img_equiv_type'] != info['img_type']
+                    or dtype is None):
+                logger.info('cannot memory map %s, '
+                            'reading instead' % extname)
+                continue
+
+            self._mmaps[type] = np.memmap(
+                filename,
+                dtype=dtype,
+                mode='r',
+                offset=info['data_start'],
+                shape=(int(np.prod(info['dims'])),),
+            )
+
+    def _get_view(self, type, start_row, shape):
+        """
+        get a read only view of a cutout in the memory map
+        """
+        npix = shape[0]*shape[1]
+        data = self._mmaps[type][start_row:start_row+npix]
+        return data.reshape(shape)
+
+    def _get_read_windows(self, iobj, icut, start_row, box_size):
+        """
+        get the first pixel and shape of the rows to read for each
+        cutout, and the columns to keep, limited to the windows
+        """
+        start_row = start_row.astype('i8')
+        nrow = box_size.astype('i8')
+        cols = np.zeros( (iobj.size, 2), dtype='i8')
+        cols[:,1] = box_size
+
+        if len(self._windows) > 0:
+            for i in range(iobj.size):
+                window = self._windows.get( (int(iobj[i]), int(icut[i])) )
+                if window is None or start_row[i] < 0:
+                    continue
+
+                row_start, row_end, col_start, col_end = window
+                start_row[i] += row_start*box_size[i]
+                nrow[i] = row_end - row_start
+                cols[i] = col_start, col_end
+
+        shapes = np.vstack([nrow, box_size]).T
+        return start_row, shapes, cols
+
+    def _get_cutout_list(self, indices):
+        """
+        get the object and cutout index for every cutout of the objects
+        """
+        ncutout = self._cat['ncutout'][indices]
+        iobj = np.repeat(indices, ncutout)
+
+        # index of each cutout within its object
+        offsets = np.cumsum(ncutout) - ncutout
+        icut = np.arange(iobj.size) - np.repeat(offsets, ncutout)
+
+        return iobj, icut
+
+    def _get_psf_shapes(self, iobj, icut):
+        """
+        get the shapes of the psf images
+        """
+        names = self._cat.dtype.names
+        if 'psf_row_size' in names:
+            nrow = self._get_cat_vals('psf_row_size', iobj, icut)
+            ncol = self._get_cat_vals('psf_col_size', iobj, icut)
+        else:
+            nrow = self._get_cat_vals('psf_box_size', iobj, icut)
+            ncol = nrow
+
+        return np.vstack([nrow, ncol]).T
+
+    def _get_cat_vals(self, name, iobj, icut):
+        """
+        get values for a column that can be per object or per cutout
+        """
+        col = self._cat[name]
+        if len(col.shape) > 1:
+            return col[iobj, icut]
+        else:
+            return col[iobj]
+
+    def _read_ext(self, extname, type, iobj, icut, start_row, shapes,
+                  cols=None):
+        """
+        read the cutouts from the extension in runs of nearby cutouts
+        and put them in the cache.  If cols is sent, only those columns
+        are kept
+        """
+        npix = shapes[:,0]*shapes[:,1]
+        w, = np.where((start_row >= 0) & (npix > 0))
+        if w.size == 0:
+            return
+
+        s = w[np.argsort(start_row[w], kind='mergesort')]
+        starts = start_row[s].astype('i8')
+        ends = starts + npix[s]
+
+        hdu = self._fits[extname]
+
+        nreads = 0
+        i = 0
+        while i < s.size:
+            run_start = starts[i]
+            run_end = ends[i]
+
+            j = i+1
+            while j < s.size and starts[j] - run_end <= self.max_gap:
+                run_end = max(run_end, ends[j])
+                j += 1
+
+            data = hdu[run_start:run_end]
+            nreads += 1
+
+            for k in range(i, j):
+                ind = s[k]
+                off = starts[k] - run_start
+                shape = (shapes[ind,0], shapes[ind,1])
+                key = (type, int(iobj[ind]), int(icut[ind]))
+                im = data[off:off+npix[ind]].reshape(shape)
+                if cols is not None:
+                    im = im[:, cols[ind,0]:cols[ind,1]]
+
+                self._cutout_cache[key] = im
+
+            i = j
+
+        logger.debug('read %d %s cutouts in %d reads' % (s.size,type,nreads))
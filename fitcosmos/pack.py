@@ -0,0 +1,512 @@
+"""
+pack files of preprocessed stamps
+
+A pack holds the observations for a range of FoF groups after best
+epoch selection, trimming and weighting, in FoF order.  All pixels for
+a group are contiguous, so the group can be loaded with a single read.
+
+extensions
+----------
+pixels: table with a single f8 column, holding for each observation the
+    image, weight, bmask (if present), psf image and psf weight
+pack_index: one row per group, with the rows for the group in the other
+    tables
+objects: one row per object, with the MultiBandObsList metadata
+obslists: one row per object and band, with the ObsList metadata
+obs: one row per observation, with the shapes, jacobians and metadata
+pack_conf: the preprocessing config and offsets file used to make the pack
+"""
+import os
+import logging
+import numpy as np
+import fitsio
+import yaml
+import esutil as eu
+import ngmix
+
+logger = logging.getLogger(__name__)
+
+# observation metadata that are stored, when present
+OBS_META = [
+    ('id','i8'),
+    ('number','i8'),
+    ('file_id','i4'),
+    ('icut','i4'),
+    ('orig_row','f8'),
+    ('orig_col','f8'),
+    ('orig_start_row','i8'),
+    ('orig_start_col','i8'),
+]
+OBS_META_DEFAULT = -9999
+
+OBSLIST_META = [
+    'flux_radius_arcsec',
+    'flux',
+    'magzp_ref',
+    'Tsky',
+]
+
+PACK_CONF_KEYS = [
+    'parspace',
+    'weight_type',
+    'keep_best_epoch',
+    'hst_band',
+    'trim_images',
+]
+
+def get_pack_conf(config, offsets=None):
+    """
+    get the parts of the config that determine the preprocessing
+
+    parameters
+    ----------
+    config: dict
+        The fit config
+    offsets: str, optional
+        The offsets file, which shifts the jacobian centers.  Only the
+        base name is recorded
+
+    returns
+    -------
+    pack_conf: dict
+    """
+    pack_conf = {key:config.get(key,None) for key in PACK_CONF_KEYS}
+    if offsets is not None:
+        offsets = os.path.basename(offsets)
+    pack_conf['offsets'] = offsets
+    return pack_conf
+
+def get_index_dtype():
+    return [
+        ('fofid','i8'),
+        ('nobj','i8'),
+        ('obj_start','i8'),
+        ('nobs','i8'),
+        ('obs_start','i8'),
+        ('npix','i8'),
+        ('pix_start','i8'),
+    ]
+
+def get_objects_dtype():
+    return [
+        ('fofid','i8'),
+        ('index','i8'),
+        ('masked_frac','f8'),
+    ]
+
+def get_obslists_dtype():
+    dt = [
+        ('fofid','i8'),
+        ('index','i8'),
+        ('band','i2'),
+        ('nobs','i4'),
+    ]
+    dt += [(name,'f8') for name in OBSLIST_META]
+    return dt
+
+def get_obs_dtype():
+    dt = [
+        ('fofid','i8'),
+        ('index','i8'),
+        ('band','i2'),
+        ('nrow','i4'),
+        ('ncol','i4'),
+        ('has_bmask','i2'),
+        ('psf_nrow','i4'),
+        ('psf_ncol','i4'),
+        ('jacobian','f8',6),
+        ('psf_jacobian','f8',6),
+    ]
+    dt += OBS_META
+    return dt
+
+class PackWriter(object):
+    """
+    write a pack file, one group at a time
+
+    The pixels are appended to the pixels table as each group is added.
+    The other tables are small and are written on close, after the
+    pixels
+
+    parameters
+    ----------
+    filename: str
+        The pack file
+    config: dict
+        The fit config, the preprocessing parts are saved in the pack
+    offsets: str, optional
+        The offsets file used in the preprocessing
+    """
+    def __init__(self, filename, config, offsets=None):
+        self.filename = filename
+        self.pack_conf = get_pack_conf(config, offsets=offsets)
+
+        self._index = []
+        self._objects = []
+        self._obslists = []
+        self._obs = []
+
+        self._npix = 0
+        self._nobj = 0
+        self._nobs = 0
+
+        logger.info('writing pack: %s' % filename)
+        self._fits = fitsio.FITS(filename, 'rw', clobber=True)
+
+    def add(self, fofid, indices, mbobs_list):
+        """
+        add a FoF group
+
+        parameters
+        ----------
+        fofid: int
+            The FoF group id
+        indices: array
+            Indices of the members in the MEDS files
+        mbobs_list: list
+            MultiBandObsList for each member
+        """
+        nobj = len(mbobs_list)
+        nband = len(mbobs_list[0])
+
+        objects = np.zeros(nobj, dtype=get_objects_dtype())
+        obslists = np.zeros(nobj*nband, dtype=get_obslists_dtype())
+        obs_rows = []
+        pixels = []
+
+        for iobj, (index, mbobs) in enumerate(zip(indices, mbobs_list)):
+            objects['fofid'][iobj] = fofid
+            objects['index'][iobj] = index
+            objects['masked_frac'][iobj] = mbobs.meta['masked_frac']
+
+            for band, obslist in enumerate(mbobs):
+                row = obslists[iobj*nband + band]
+                row['fofid'] = fofid
+                row['index'] = index
+                row['band'] = band
+                row['nobs'] = len(obslist)
+                for name in OBSLIST_META:
+                    row[name] = obslist.meta[name]
+
+                for obs in obslist:
+                    obs_rows.append(
+                        _get_obs_row(fofid, index, band, obs)
+                    )
+                    pixels += _get_obs_pixels(obs)
+
+        obs = eu.numpy_util.combine_arrlist(obs_rows)
+
+        pix = np.zeros(sum(p.size for p in pixels), dtype=[('pix','f8')])
+        pix['pix'] = np.concatenate([p.ravel() for p in pixels])
+
+        if 'pixels' in self._fits:
+            self._fits['pixels'].append(pix)
+        else:
+            self._fits.write(pix, extname='pixels')
+
+        index = np.zeros(1, dtype=get_index_dtype())
+        index['fofid'] = fofid
+        index['nobj'] = nobj
+        index['obj_start'] = self._nobj
+        index['nobs'] = obs.size
+        index['obs_start'] = self._nobs
+        index['npix'] = pix.size
+        index['pix_start'] = self._npix
+
+        self._index.append(index)
+        self._objects.append(objects)
+        self._obslists.append(obslists)
+        self._obs.append(obs)
+
+        self._nobj += nobj
+        self._nobs += obs.size
+        self._npix += pix.size
+
+    def close(self):
+        """
+        write the tables and close the file
+        """
+        if len(self._index) == 0:
+            # no owned groups in the range
+            self._fits.create_table_hdu(
+                dtype=[('pix','f8')],
+                extname='pixels',
+            )
+            for extname, dtype in [('pack_index', get_index_dtype()),
+                                   ('objects', get_objects_dtype()),
+                                   ('obslists', get_obslists_dtype()),
+                                   ('obs', get_obs_dtype())]:
+                self._fits.create_table_hdu(dtype=dtype, extname=extname)
+        else:
+            for extname, dlist in [('pack_index', self._index),
+                                   ('objects', self._objects),
+                                   ('obslists', self._obslists),
+                                   ('obs', self._obs)]:
+                self._fits.write(
+                    eu.numpy_util.combine_arrlist(dlist),
+                    extname=extname,
+                )
+
+        conf = np.zeros(1, dtype=[('conf','S2000')])
+        conf['conf'] = yaml.dump(self.pack_conf)
+        self._fits.write(conf, extname='pack_conf')
+
+        self._fits.close()
+
+class PackReader(object):
+    """
+    read groups from a pack file
+
+    The tables for the requested range of groups are read on
+    construction.  The pixels for each group are read with a single
+    read in get_mbobs_list
+
+    parameters
+    ----------
+    filename: str
+        The pack file
+    start: int
+        First FoF group to read
+    end: int
+        Last FoF group to read, inclusive
+    config: dict, optional
+        The fit config.  If sent, it is checked that the pack was made
+        with the same preprocessing
+    offsets: str, optional
+        The offsets file, checked along with the config
+    """
+    def __init__(self, filename, start, end, config=None, offsets=None):
+        self.filename = filename
+
+        logger.info('reading pack: %s' % filename)
+        self._fits = fitsio.FITS(filename)
+
+        if config is not None:
+            self._check_conf(config, offsets)
+
+        self._load_tables(start, end)
+
+    def get_mbobs_list(self, fofid, indices=None):
+        """
+        get the mbobs_list for the FoF group
+
+        parameters
+        ----------
+        fofid: int
+            The FoF group id
+        indices: array, optional
+            Indices of the members in the MEDS files.  If sent, it is
+            checked that the pack holds the same members, e.g. that it
+            was not made from an older fof file
+
+        returns
+        -------
+        mbobs_list: list
+            MultiBandObsList for each member
+        """
+        assert fofid in self._rows, 'FoF id %d not in pack' % fofid
+        index = self.index[self._rows[fofid]]
+
+        pix_start = index['pix_start']
+        pix = self._fits['pixels']['pix'][pix_start:pix_start+index['npix']]
+
+        obj_start = index['obj_start'] - self._obj_offset
+        obs_start = index['obs_start'] - self._obs_offset
+
+        obj_end = obj_start+index['nobj']
+        nband = self.nband
+
+        objects = self.objects[obj_start:obj_end]
+        if indices is not None:
+            assert np.array_equal(objects['index'], indices), \
+                'pack members do not match the fof file for FoF id %d' % fofid
+
+        obslists = self.obslists[obj_start*nband:obj_end*nband]
+        obs = self.obs[obs_start:obs_start+index['nobs']]
+
+        mbobs_list = []
+        iobs = 0
+        ipix = 0
+        for iobj in range(objects.size):
+            mbobs = ngmix.MultiBandObsList()
+            mbobs.meta['masked_frac'] = objects['masked_frac'][iobj]
+
+            for band in range(nband):
+                row = obslists[iobj*nband + band]
+
+                obslist = ngmix.ObsList()
+                for name in OBSLIST_META:
+                    obslist.meta[name] = row[name]
+
+                for i in range(row['nobs']):
+                    tobs, npix = _make_obs(obs[iobs], pix[ipix:])
+                    obslist.append(tobs)
+                    iobs += 1
+                    ipix += npix
+
+                mbobs.append(obslist)
+
+            mbobs_list.append(mbobs)
+
+        return mbobs_list
+
+    def _load_tables(self, start, end):
+        """
+        read the table rows for the groups in the range
+        """
+        index = self._fits['pack_index'].read()
+        w, = np.where((index['fofid'] >= start) & (index['fofid'] <= end))
+        self.index = index[w]
+        self._rows = {fofid:i for i, fofid in enumerate(self.index['fofid'])}
+
+        if w.size == 0:
+            self.nband = 0
+            self._obj_offset = 0
+            self._obs_offset = 0
+            self.objects = np.zeros(0, dtype=get_objects_dtype())
+            self.obslists = np.zeros(0, dtype=get_obslists_dtype())
+            self.obs = np.zeros(0, dtype=get_obs_dtype())
+            return
+
+        # groups are in fofid order, so the rows are contiguous
+        first, last = self.index[0], self.index[-1]
+
+        self._obj_offset = first['obj_start']
+        obj_end = last['obj_start'] + last['nobj']
+        self.objects = self._fits['objects'][self._obj_offset:obj_end]
+
+        self.nband = (
+            self._fits['obslists'].get_nrows()
+            // self._fits['objects'].get_nrows()
+        )
+        self.obslists = self._fits['obslists'][
+            self._obj_offset*self.nband:obj_end*self.nband
+        ]
+
+        self._obs_offset = first['obs_start']
+        obs_end = last['obs_start'] + last['nobs']
+        self.obs = self._fits['obs'][self._obs_offset:obs_end]
+
+    def _check_conf(self, config, offsets):
+        """
+        check the pack was made with the same preprocessing as the
+        config
+        """
+        conf = self._fits['pack_conf'].read()['conf'][0]
+        if isinstance(conf, bytes):
+            conf = conf.decode()
+
+        pack_conf = yaml.safe_load(conf)
+        this_conf = get_pack_conf(config, offsets=offsets)
+        assert pack_conf == this_conf, \
+            ('pack preprocessing %s does not '
+             'match config %s' % (pack_conf, this_conf))
+
+def _get_jacobian_pars(jac):
+    """
+    get the pars for a jacobian, in the order used for Jacobian()
+    """
+    row, col = jac.get_cen()
+    return [
+        row,
+        col,
+        jac.get_dudrow(),
+        jac.get_dudcol(),
+        jac.get_dvdrow(),
+        jac.get_dvdcol(),
+    ]
+
+def _make_jacobian(pars):
+    """
+    make a jacobian from the stored pars
+    """
+    return ngmix.Jacobian(
+        row=pars[0],
+        col=pars[1],
+        dudrow=pars[2],
+        dudcol=pars[3],
+        dvdrow=pars[4],
+        dvdcol=pars[5],
+    )
+
+def _get_obs_row(fofid, index, band, obs):
+    """
+    get the obs table row for an observation
+    """
+    row = np.zeros(1, dtype=get_obs_dtype())
+    row['fofid'] = fofid
+    row['index'] = index
+    row['band'] = band
+    row['nrow'], row['ncol'] = obs.image.shape
+    row['has_bmask'] = obs.has_bmask()
+    row['psf_nrow'], row['psf_ncol'] = obs.psf.image.shape
+    row['jacobian'][0] = _get_jacobian_pars(obs.jacobian)
+    row['psf_jacobian'][0] = _get_jacobian_pars(obs.psf.jacobian)
+
+    for name, dt in OBS_META:
+        row[name] = obs.meta.get(name, OBS_META_DEFAULT)
+
+    return row
+
+def _get_obs_pixels(obs):
+    """
+    get the pixel arrays for an observation, in the order stored
+    """
+    pixels = [obs.image, obs.weight]
+    if obs.has_bmask():
+        pixels.append(obs.bmask)
+    pixels += [obs.psf.image, obs.psf.weight]
+    return pixels
+
+def _make_obs(row, pix):
+    """
+    make an observation from the obs table row and the pixels, which
+    start with those for this observation
+
+    returns
+    -------
+    obs, npix: the observation and the number of pixels used
+    """
+    shape = (row['nrow'], row['ncol'])
+    psf_shape = (row['psf_nrow'], row['psf_ncol'])
+    size = shape[0]*shape[1]
+    psf_size = psf_shape[0]*psf_shape[1]
+
+    ipix = 0
+    image = pix[ipix:ipix+size].reshape(shape)
+    ipix += size
+    weight = pix[ipix:ipix+size].reshape(shape)
+    ipix += size
+
+    if row['has_bmask']:
+        bmask = pix[ipix:ipix+size].reshape(shape).astype('i4')
+        ipix += size
+    else:
+        bmask = None
+
+    psf_image = pix[ipix:ipix+psf_size].reshape(psf_shape)
+    ipix += psf_size
+    psf_weight = pix[ipix:ipix+psf_size].reshape(psf_shape)
+    ipix += psf_size
+
+    psf_obs = ngmix.Observation(
+        psf_image,
+        weight=psf_weight,
+        jacobian=_make_jacobian(row['psf_jacobian']),
+    )
+
+    meta = {}
+    for name, dt in OBS_META:
+        if row[name] != OBS_META_DEFAULT:
+            meta[name] = row[name]
+
+    obs = ngmix.Observation(
+        image,
+        weight=weight,
+        bmask=bmask,
+        jacobian=_make_jacobian(row['jacobian']),
+        meta=meta,
+        psf=psf_obs,
+    )
+
+    return obs, ipix
@@ -7,6 +7,8 @@ TODO:
     - note we are recording overall maskfrac
 
 """
+import sys
+import signal
 import numpy as np
 import logging
 import ngmix
@@ -17,6 +19,10 @@ import esutil as eu
 
 from . import fitting
 from . import files
+from . import fofs
+from . import writer
+from . import medsreaders
+from . import pack
 import time
 from . import vis
 from . import util
@@ -33,56 +39,306 @@ class Processor(object):
         self._set_rng()
         self._load_conf()
         self._load_meds_files()
-        self._load_fofs()
+        self._load_fof_index()
         self._set_fof_range()
+        self._load_fofs()
+        self._load_fof_cuts()
+        self._load_pack()
         self._set_fitter()
 
     def go(self):
         """
         process the requested FoF groups
-        """
-        olist=[]
-        elist=[]
 
+        With nproc > 1 the groups are fit in a pool of worker processes,
+        largest first.  Each group uses its own random seed, and the
+        OutputWriter puts the groups back in fofid order on close, so
+        the output is the same as for the serial run.
+
+        Otherwise, with prefetch > 0, the data for the next groups are
+        loaded in a background thread while the current group is fit.
+
+        The results are written by an OutputWriter every --write-every
+        groups, so memory does not grow with the size of the split.  The
+        groups on disk are recorded in a checkpoint file every
+        --checkpoint-time seconds, and when the job is interrupted by
+        SIGINT/SIGTERM or fails.  With --resume the groups in the
+        checkpoint are not refit.
+        """
         tm0 = time.time()
         nfofs = self.end-self.start+1
 
+        fofids=[]
         for fofid in range(self.start,self.end+1):
-            logger.info('processing: %d:%d' % (fofid,self.end))
-
-            tp = time.time()
-            output, epochs_data = self._process_fof(fofid)
-            tp = time.time()-tp
-            logger.info('FoF time: %g' % tp)
+            if not self._is_owned(fofid):
+                logger.info('skipping %d: not owned by this tile' % fofid)
+                continue
+            fofids.append(fofid)
+
+        output_writer = writer.OutputWriter(
+            self.args.output,
+            write_every=self.args.write_every,
+            resume=self.args.resume,
+        )
 
-            olist.append(output)
-            if epochs_data is not None:
-                elist.append(epochs_data)
+        todo = [
+            fofid for fofid in fofids
+            if fofid not in output_writer.completed
+        ]
 
-        output = eu.numpy_util.combine_arrlist(olist)
-        if len(elist) > 0:
-            epochs_data = eu.numpy_util.combine_arrlist(elist)
+        if self.args.nproc > 1:
+            result_iter = self._process_fofs_pool(todo)
+        elif self.args.prefetch > 0:
+            result_iter = self._process_fofs_prefetch(todo)
         else:
-            epochs_data = None
+            result_iter = (
+                (fofid, self._process_fof_timed(fofid)) for fofid in todo
+            )
+
+        self._set_signal_handlers()
+        try:
+            tcheck = time.time()
+            for fofid, (output, epochs_data) in result_iter:
+                output_writer.add(fofid, output, epochs_data)
+
+                if time.time()-tcheck > self.args.checkpoint_time:
+                    output_writer.checkpoint()
+                    tcheck = time.time()
+
+        except BaseException:
+            # stops the pool or prefetch thread
+            result_iter.close()
+
+            logger.info('processing stopped, saving completed groups')
+            try:
+                output_writer.checkpoint()
+            finally:
+                output_writer.stop()
+            raise
+        finally:
+            self._reset_signal_handlers()
+
+        output_writer.close()
 
         tm = time.time()-tm0
         print('total time: %g' % tm)
         print('time per: %g' % (tm/nfofs))
 
-        self._write_output(output, epochs_data)
+    def _process_fof_timed(self, fofid):
+        """
+        process a single FoF group, logging the time
+        """
+        logger.info('processing: %d:%d' % (fofid,self.end))
+
+        tp = time.time()
+        output, epochs_data = self._process_fof(fofid)
+        tp = time.time()-tp
+        logger.info('FoF time: %g' % tp)
+
+        return output, epochs_data
+
+    def _process_fofs_prefetch(self, fofids):
+        """
+        process the groups while a reader thread loads the data for the
+        next groups into a queue of depth --prefetch
+
+        yields (fofid, result) as each group is finished
+        """
+        import threading
+        import queue
+
+        data_queue = queue.Queue(maxsize=self.args.prefetch)
+        load_time = [0.0]
+
+        def reader():
+            for fofid in fofids:
+                try:
+                    tl = time.time()
+                    data = self._load_fof(fofid)
+                    load_time[0] += time.time()-tl
+                except Exception as err:
+                    data_queue.put( (fofid, None, err) )
+                    return
+
+                data_queue.put( (fofid, data, None) )
+
+        thread = threading.Thread(target=reader)
+        thread.daemon = True
+        thread.start()
+
+        wait_time = 0.0
+        fit_time = 0.0
+
+        for i in range(len(fofids)):
+            tw = time.time()
+            fofid, data, err = data_queue.get()
+            wait_time += time.time()-tw
+
+            if err is not None:
+                raise err
+
+            logger.info('processing: %d:%d' % (fofid,self.end))
+            tf = time.time()
+            res = self._fit_fof(fofid, *data)
+            tf = time.time()-tf
+            fit_time += tf
+            logger.info('FoF time: %g' % tf)
+
+            yield fofid, res
+
+        thread.join()
+
+        logger.info('time loading data: %g' % load_time[0])
+        logger.info('time fitting: %g' % fit_time)
+        logger.info('time waiting for data: %g' % wait_time)
+
+    def _process_fofs_pool(self, fofids):
+        """
+        process the groups in a pool of workers, each with its own
+        MEDS files and fitter.  The largest groups are sent first so
+        that no worker is left with a large group at the end
+
+        yields (fofid, result) as each group is finished
+        """
+        import multiprocessing
+
+        assert not (self.args.show or self.args.save),\
+            'cannot make plots with nproc > 1'
+
+        lengths = self.fof_index['length'][fofids]
+        s = np.argsort(-lengths, kind='mergesort')
+        ordered = [fofids[i] for i in s]
+
+        logger.info('processing %d groups with %d processes' % (len(fofids),self.args.nproc))
+
+        pool = multiprocessing.Pool(
+            processes=self.args.nproc,
+            initializer=_init_pool_processor,
+            initargs=(self.args,),
+        )
+        try:
+            for fofid, res in pool.imap_unordered(_process_pool_fof, ordered):
+                yield fofid, res
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+    def _set_signal_handlers(self):
+        """
+        condor sends SIGINT on eviction, and other batch systems send
+        SIGTERM.  Convert these to exceptions so the completed groups
+        on disk are recorded in the checkpoint before exiting
+        """
+        self._old_handlers = {}
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self._old_handlers[signum] = signal.signal(
+                signum,
+                _handle_stop_signal,
+            )
+
+    def _reset_signal_handlers(self):
+        """
+        restore the signal handlers
+        """
+        for signum, handler in self._old_handlers.items():
+            signal.signal(signum, handler)
+
+    def _is_owned(self, fofid):
+        """
+        check if the group is owned by this tile.  Groups are owned
+        unless the fof file marks them otherwise
+        """
+        if 'owned' not in self.fof_index.dtype.names:
+            return True
+
+        return self.fof_index['owned'][fofid] != 0
 
     def _process_fof(self, fofid):
         """
         process single FoF group
         """
-        w,=np.where(self.fofs['fofid'] == fofid)
-        logger.info('FoF size: %d' % w.size)
-        assert w.size > 0,'no objects found for FoF id %d' % fofid
+        indices, mbobs_list = self._load_fof(fofid)
+        return self._fit_fof(fofid, indices, mbobs_list)
+
+    def _load_fof(self, fofid):
+        """
+        load and prepare the data for a FoF group
 
-        indices=self.fofs['number'][w]-1
+        This may be run in the prefetch thread, so it only uses
+        load_rng, not the rng used by the fitter
+        """
+        indices = self._get_fit_indices(fofid)
+
+        # each group gets its own seeds, so the results do not depend
+        # on the order in which groups are processed
+        self.load_rng.seed([self.args.seed, fofid, 1])
 
         logger.debug('loading data')
-        mbobs_list = self._get_fof_mbobs_list(indices)
+        if self.pack is not None:
+            mbobs_list = self.pack.get_mbobs_list(fofid, indices=indices)
+        else:
+            mbobs_list = self._get_fof_mbobs_list(indices)
+
+        if 'flux' in self.config['parspace']:
+            for index, mbobs in zip(indices, mbobs_list):
+                self._add_input_model_pars(mbobs, index)
+
+        return indices, mbobs_list
+
+    def _get_fof_indices(self, fofid):
+        """
+        get the indices of the members of a FoF group
+        """
+        start = self.fof_index['start'][fofid] - self.fof_row_start
+        length = self.fof_index['length'][fofid]
+        logger.info('FoF size: %d' % length)
+        assert length > 0,'no objects found for FoF id %d' % fofid
+
+        return self.fofs['number'][start:start+length]-1
+
+    def _get_fit_indices(self, fofid):
+        """
+        get the indices of the objects to fit for a FoF group: the
+        members, followed by the nbrs linked to them across the cuts
+        made when splitting large groups, see fofs.FoFSplitter
+        """
+        indices = self._get_fof_indices(fofid)
+        if self.fof_cuts is None:
+            return indices
+
+        w, = np.where(np.isin(self.fof_cuts['number'], indices+1))
+        nbrs = np.unique(self.fof_cuts['nbr_number'][w]) - 1
+        nbrs = nbrs[~np.isin(nbrs, indices)]
+        if nbrs.size == 0:
+            return indices
+
+        logger.info('adding %d nbrs across cuts' % nbrs.size)
+        return np.concatenate([indices, nbrs])
+
+    def _get_fof_owned(self, fofid):
+        """
+        get the ownership of the members of a FoF group.  Objects are
+        owned unless the fof file marks them otherwise
+        """
+        if 'owned' not in self.fofs.dtype.names:
+            return 1
+
+        start = self.fof_index['start'][fofid] - self.fof_row_start
+        length = self.fof_index['length'][fofid]
+        return self.fofs['owned'][start:start+length]
+
+    def _fit_fof(self, fofid, indices, mbobs_list):
+        """
+        fit the loaded data for a FoF group
+
+        The nbrs across cuts, if any, are fit along with the members
+        but are not output; they are output with their own group
+        """
+        self.rng.seed([self.args.seed, fofid])
 
         if self.args.save or self.args.show:
             self._doplots(fofid, mbobs_list)
@@ -95,26 +351,53 @@ class Processor(object):
         if self.args.save or self.args.show:
             self._doplots_compare_model(fofid, mbobs_list, output)
 
+        nmembers = self.fof_index['length'][fofid]
+        if len(indices) > nmembers:
+            output, epochs_data = _drop_cut_nbrs(
+                output,
+                epochs_data,
+                nmembers,
+            )
+
         return output, epochs_data
 
     def _add_extra_outputs(self, indices, output, fofid):
 
-        m = self.mb_meds.mlist[0]
-        output['id'] = m['id'][indices]
-        output['ra'] = m['ra'][indices]
-        output['dec'] = m['dec'][indices]
-        output['flux_auto'] = m['flux_auto'][indices]
-        output['mag_auto'] = m['mag_auto'][indices]
+        cat = self.cat_cache[0]
+        output['id'] = cat['id'][indices]
+        output['ra'] = cat['ra'][indices]
+        output['dec'] = cat['dec'][indices]
+        output['flux_auto'] = cat['flux_auto'][indices]
+        output['mag_auto'] = cat['mag_auto'][indices]
         output['fof_id'] = fofid
 
+        # any nbrs across cuts come after the members
+        nmembers = self.fof_index['length'][fofid]
+        output['owned'][:nmembers] = self._get_fof_owned(fofid)
+
     def _get_fof_mbobs_list(self, indices):
         """
         load the mbobs_list for the input FoF group list
+
+        The cutouts for all members are first read in bulk, in file order.
+        When trimming, only the trimmed part of each cutout is read
         """
-        mbobs_list=[]
-        for index in indices:
-            mbobs = self._get_mbobs(index)
-            mbobs_list.append(mbobs)
+        windows = self._get_trim_windows(indices)
+
+        for band,m in enumerate(self.mb_meds.mlist):
+            if windows is not None:
+                m.read_cutouts(indices, windows=windows[band])
+            else:
+                m.read_cutouts(indices)
+
+        try:
+            mbobs_list=[]
+            for index in indices:
+                mbobs = self._get_mbobs(index)
+                mbobs_list.append(mbobs)
+        finally:
+            for m in self.mb_meds.mlist:
+                m.clear_cache()
 
         return mbobs_list
 
@@ -137,16 +420,8 @@ class Processor(object):
 
         mbobs.meta['masked_frac'] = util.get_masked_frac(mbobs)
 
-        if 'flux' in self.config['parspace']:
-            mname=self.config['mof']['model']
-            name = '%s_pars' % mname
-            mbobs.meta['input_model_pars'] = self.model_pars[name][index].copy()
-            mbobs.meta['input_flags'] = self.model_pars['flags'][index].copy()
-            #logger.debug('added input pars: %s' % str(mbobs.meta['input_model_pars']))
-
-
         for band,obslist in enumerate(mbobs):
-            m=self.mb_meds.mlist[band]
+            cat=self.cat_cache[band]
 
             if hasattr(self,'offsets'):
                 #print('doing offsets')
@@ -166,17 +441,16 @@ class Processor(object):
 
             scale = obslist[0].jacobian.scale
 
-            flux_radius_arcsec = m['flux_radius'][index,1]*scale
+            flux_radius_arcsec = cat['flux_radius'][index]*scale
             meta = {
-                #'Tsky': 2* (m['iso_radius_arcsec'][index]*0.5)**2,
                 #'Tsky': 0.1,
                 'flux_radius_arcsec': flux_radius_arcsec,
-                'flux': m['flux_auto'][index],
+                'flux': cat['flux_auto'][index],
                 'magzp_ref': self.magzp_refs[band],
             }
             # e.g. the injection pipeline might already have set it
             if 'Tsky' not in obslist.meta:
-                meta['Tsky'] = 2* (m['iso_radius_arcsec'][index]*0.5)**2
+                meta['Tsky'] = cat['Tsky'][index]
 
             obslist.meta.update(meta)
 
@@ -185,11 +459,24 @@ class Processor(object):
                 for obs in obslist:
                     pixel_scale2 = obs.jacobian.get_det()
                     pixel_scale4 = pixel_scale2*pixel_scale2
-                    obs.image *= 1/pixel_scale2
-                    obs.weight *= pixel_scale4
+                    # not in place, so this does not rely on ngmix
+                    # having copied the pixels out of a memory mapped
+                    # MEDS file
+                    obs.image = obs.image*(1/pixel_scale2)
+                    obs.weight = obs.weight*pixel_scale4
 
         return mbobs
 
+    def _add_input_model_pars(self, mbobs, index):
+        """
+        add the input model pars when doing flux only fitting
+        """
+        mname=self.config['mof']['model']
+        name = '%s_pars' % mname
+        mbobs.meta['input_model_pars'] = self.model_pars[name][index].copy()
+        mbobs.meta['input_flags'] = self.model_pars['flags'][index].copy()
+        #logger.debug('added input pars: %s' % str(mbobs.meta['input_model_pars']))
+
     def _inject_fake_objects(self, mbobs):
         """
         inject a simple model for quick tests
@@ -284,7 +571,7 @@ class Processor(object):
                 wtmax = obs.weight.max()
                 err = np.sqrt(1.0/wtmax)
 
-                image += self.rng.normal(
+                image += self.load_rng.normal(
                     scale=err,
                     size=image.shape,
                 )
@@ -327,69 +614,41 @@ class Processor(object):
         """
         trim the images down to a minimal size
         """
-        # hst_band can be None if we are only processing non-hst data
-        hst_band=self.config['hst_band']
         logger.debug('trimming')
 
         min_size = self.config['trim_images']['min_size']
         max_size = self.config['trim_images']['max_size']
 
-        min_rad = min_size/2.0
-        max_rad = max_size/2.0
-
-        fwhm=1.5
-        sigma=fwhm/2.35
-        exrad=3*sigma
-
         new_mbobs=ngmix.MultiBandObsList()
         new_mbobs.meta.update( mbobs.meta )
         for band,obslist in enumerate(mbobs):
 
-            m=self.mb_meds.mlist[band]
-            rad = m['iso_radius_arcsec'][index]*3.0
-
-            if band != hst_band:
-                #rad = np.sqrt(rad**2 + 0.4**2)
-                rad = np.sqrt(rad**2 + exrad**2)
+            cat = self.cat_cache[band]
+            rad = cat['rad_arcsec'][index]
 
             new_obslist=ngmix.ObsList()
             new_obslist.meta.update( obslist.meta )
             for obs in obslist:
-                imshape=obs.image.shape
-                if imshape[0] > min_size:
+                if cat['box_size'][index] > min_size:
 
                     meta = obs.meta
                     jac = obs.jacobian
                     cen = jac.get_cen()
-                    rowpix=int(round(cen[0]))
-                    colpix=int(round(cen[1]))
-
-
-                    scale = jac.scale
-                    radpix = rad/scale
-
-                    if radpix < min_rad:
-                        radpix = min_rad
-
-                    if radpix > max_rad:
-                        radpix = max_rad
-
-                    radpix = int(radpix)-1
-
-                    row_start = rowpix-radpix
-                    row_end   = rowpix+radpix+1
-                    col_start = colpix-radpix
-                    col_end   = colpix+radpix+1
-
-                    if row_start < 0:
-                        row_start = 0
-                    if row_end > imshape[0]:
-                        row_end = imshape[0]
-                    if col_start < 0:
-                        col_start = 0
-                    if col_end > imshape[1]:
-                        col_end = imshape[1]
 
+                    if meta.get('trimmed',False):
+                        # already trimmed on reading, see _get_trim_windows
+                        row_start, col_start = 0, 0
+                        row_end, col_end = obs.image.shape
+                    else:
+                        row_start, row_end, col_start, col_end = \
+                            _get_trim_window(
+                                cen,
+                                jac.scale,
+                                rad,
+                                obs.image.shape,
+                                min_size,
+                                max_size,
+                            )
 
                     subim = obs.image[
                         row_start:row_end,
@@ -425,6 +684,65 @@ class Processor(object):
 
 
 
+    def _get_trim_windows(self, indices):
+        """
+        get the trim windows for the cutouts of the objects, so that only
+        the pixels kept by _trim_images are read
+
+        The windows are computed from the cached catalog, the same way as
+        in _trim_images.  No windows are used if we are not trimming or
+        if we are injecting objects, which is done on the full stamp.
+        When keeping the best epoch, objects with more than one epoch in
+        a band are read in full, as the best epoch is chosen using the
+        full weight maps
+
+        returns
+        -------
+        windows: list or None
+            For each band, a dict keyed by (index, icut) holding
+            (row_start, row_end, col_start, col_end)
+        """
+        if ('trim_images' not in self.config
+                or not self.config['trim_images']['trim']):
+            return None
+
+        if 'inject' in self.config and self.config['inject']['do_inject']:
+            return None
+
+        min_size = self.config['trim_images']['min_size']
+        max_size = self.config['trim_images']['max_size']
+
+        windows=[]
+        for cat in self.cat_cache:
+            band_windows={}
+            for index in indices:
+                ncutout = cat['ncutout'][index]
+                box_size = cat['box_size'][index]
+
+                if self.config['keep_best_epoch'] and ncutout > 1:
+                    continue
+
+                if box_size <= min_size:
+                    continue
+
+                for icut in range(ncutout):
+                    cen = (
+                        cat['cutout_row'][index,icut],
+                        cat['cutout_col'][index,icut],
+                    )
+                    band_windows[(int(index),icut)] = _get_trim_window(
+                        cen,
+                        cat['jacobian_scale'][index,icut],
+                        cat['rad_arcsec'][index],
+                        (box_size, box_size),
+                        min_size,
+                        max_size,
+                    )
+
+            windows.append(band_windows)
+
+        return windows
+
     def _set_weight(self, mbobs, index):
         """
         set the weight
@@ -438,20 +756,8 @@ class Processor(object):
         if self.config['weight_type'] == 'weight':
             return
 
-        # hst_band can be None if we are only processing non-hst data
-        hst_band=self.config['hst_band']
-
-        fwhm=1.5
-        sigma=fwhm/2.35
-        exrad=3*sigma
-
         for band,obslist in enumerate(mbobs):
-            m=self.mb_meds.mlist[band]
-            rad = m['iso_radius_arcsec'][index]*3.0
-
-            if band != hst_band:
-                #rad = np.sqrt(rad**2 + 0.4**2)
-                rad = np.sqrt(rad**2 + exrad**2)
+            rad = self.cat_cache[band]['rad_arcsec'][index]
 
             for obs in obslist:
                 imshape=obs.image.shape
@@ -504,22 +810,15 @@ class Processor(object):
             if 'q'==input('hit a key (q to quit): '):
                 stop
 
-    def _write_output(self, output, epochs_data):
-        """
-        write the output as well as information from the epochs
-        """
-        logger.info('writing output: %s' % self.args.output)
-        with fitsio.FITS(self.args.output,'rw',clobber=True) as fits:
-            fits.write(output, extname='model_fits')
-            if epochs_data is not None:
-                fits.write(epochs_data, extname='epochs_data')
-
     def _set_rng(self):
         """
         set the rng given the input seed
         """
         self.rng = np.random.RandomState(self.args.seed)
 
+        # used when loading data, which can be done in another thread
+        self.load_rng = np.random.RandomState(self.args.seed)
+
     def _load_conf(self):
         """
         load the yaml config
@@ -570,19 +869,40 @@ class Processor(object):
             raise ValueError('bad parspace "%s", should be '
                              '"ngmix" or "galsim" or "galsim-flux"')
 
+    def _load_fof_index(self):
+        """
+        load the index of the FoF groups.  For older files without an
+        index, the full fofs table is read and the index is made here
+        """
+        self.fofs = None
+        self.fof_index = files.load_fof_index(self.args.fofs)
+
+        if self.fof_index is None:
+            logger.info('no fof_index found, reading all fofs')
+            fof_data, = files.load_fofs(self.args.fofs, extensions=['fofs'])
+            self.fofs, self.fof_index = fofs.sort_fofs(fof_data)
+
     def _load_fofs(self):
         """
-        load FoF group data from the input file
+        load the rows of the fofs table for the requested groups
         """
-        nbrs, fofs = files.load_fofs(self.args.fofs)
-        self.fofs = fofs
+        if self.fofs is None:
+            self.fofs = files.load_fof_range(
+                self.args.fofs,
+                self.fof_index,
+                self.start,
+                self.end,
+            )
+            self.fof_row_start = self.fof_index['start'][self.start]
+        else:
+            self.fof_row_start = 0
 
     def _set_fof_range(self):
         """
         set the FoF range to be processed
         """
-        nfofs = self.fofs['fofid'].max()+1
-        assert nfofs == np.unique(self.fofs['fofid']).size
+        nfofs = self.fof_index.size
+        assert np.all(self.fof_index['fofid'] == np.arange(nfofs))
 
         self.start=self.args.start
         self.end=self.args.end
@@ -599,6 +919,28 @@ class Processor(object):
             mess = mess % (self.start,self.end,0,nfofs-1)
             raise ValueError(mess)
 
+    def _load_fof_cuts(self):
+        """
+        load the links cut when splitting large groups, if present
+        """
+        self.fof_cuts = files.load_fof_cuts(self.args.fofs)
+        if self.fof_cuts is not None:
+            logger.info('loaded %d fof cuts' % self.fof_cuts.size)
+
+    def _load_pack(self):
+        """
+        open the pack of preprocessed stamps, if sent
+        """
+        self.pack = None
+        if self.args.pack is not None:
+            self.pack = pack.PackReader(
+                self.args.pack,
+                self.start,
+                self.end,
+                config=self.config,
+                offsets=self.args.offsets,
+            )
+
     def _load_meds_files(self):
         """
         load all MEDS files
@@ -606,7 +948,8 @@ class Processor(object):
         mlist=[]
         for f in self.args.meds:
             logger.info('loading meds: %s' % f)
-            mlist.append( ngmix.medsreaders.NGMixMEDS(f) )
+            m = medsreaders.BulkNGMixMEDS(f, mmap=self.args.mmap)
+            mlist.append(m)
 
         self.mb_meds = ngmix.medsreaders.MultiBandNGMixMEDS(mlist)
 
@@ -615,6 +958,8 @@ class Processor(object):
             meta=m.get_meta()
             self.magzp_refs.append(meta['magzp_ref'][0])
 
+        self._set_cat_cache()
+
         if self.args.offsets is not None:
             logger.info('reading offsets: %s' % self.args.offsets)
             self.offsets=fitsio.read(self.args.offsets)
@@ -636,3 +981,219 @@ class Processor(object):
                 'some offsets ids did not match'
 
             self.offsets = self.offsets[mo]
+
+    def _set_cat_cache(self):
+        """
+        copy the catalog columns used for each object into native byte
+        order, contiguous arrays, one dict per band, and precompute the
+        quantities derived from them
+
+        Tsky: the guess for T, 2*(iso_radius_arcsec/2)**2
+        rad_arcsec: radius for trimming and the circular mask,
+            3*iso_radius_arcsec.  For non hst bands this is added in
+            quadrature with 3 sigma of a fake 1.5 arcsec fwhm psf
+        jacobian_scale: pixel scale of each cutout, as in the
+            ngmix Jacobian
+        """
+        # hst_band can be None if we are only processing non-hst data;
+        # it is only required when trimming or masking
+        hst_band=self.config.get('hst_band',None)
+
+        fwhm=1.5
+        sigma=fwhm/2.35
+        exrad=3*sigma
+
+        self.cat_cache=[]
+        for band,m in enumerate(self.mb_meds.mlist):
+            cat = {}
+            for name in CAT_CACHE_COLUMNS:
+                cat[name] = _to_native(m[name])
+
+            # only the half light radius is used
+            cat['flux_radius'] = _to_native(cat['flux_radius'][:,1])
+
+            iso_rad = cat['iso_radius_arcsec']
+            cat['Tsky'] = 2*(iso_rad*0.5)**2
+
+            rad = iso_rad*3.0
+            if band != hst_band:
+                rad = np.sqrt(rad**2 + exrad**2)
+            cat['rad_arcsec'] = rad
+
+            det = cat['dudrow']*cat['dvdcol'] - cat['dudcol']*cat['dvdrow']
+            cat['jacobian_scale'] = np.sqrt(np.abs(det))
+
+            self.cat_cache.append(cat)
+
+
+# columns copied by Processor._set_cat_cache
+CAT_CACHE_COLUMNS = [
+    'id',
+    'ra',
+    'dec',
+    'flux_auto',
+    'mag_auto',
+    'flux_radius',
+    'iso_radius_arcsec',
+    'ncutout',
+    'box_size',
+    'cutout_row',
+    'cutout_col',
+    'dudrow',
+    'dudcol',
+    'dvdrow',
+    'dvdcol',
+]
+
+def _get_trim_window(cen, scale, rad, imshape, min_size, max_size):
+    """
+    get the window used to trim a stamp
+
+    parameters
+    ----------
+    cen: (row, col)
+        Center of the object in the stamp
+    scale: float
+        Pixel scale
+    rad: float
+        Trim radius in arcsec
+    imshape: (nrow, ncol)
+        Shape of the stamp
+    min_size, max_size: int
+        The radius is limited to between half of these sizes
+
+    returns
+    -------
+    row_start, row_end, col_start, col_end
+    """
+    min_rad = min_size/2.0
+    max_rad = max_size/2.0
+
+    rowpix=int(round(cen[0]))
+    colpix=int(round(cen[1]))
+
+    radpix = rad/scale
+
+    if radpix < min_rad:
+        radpix = min_rad
+
+    if radpix > max_rad:
+        radpix = max_rad
+
+    radpix = int(radpix)-1
+
+    row_start = rowpix-radpix
+    row_end   = rowpix+radpix+1
+    col_start = colpix-radpix
+    col_end   = colpix+radpix+1
+
+    if row_start < 0:
+        row_start = 0
+    if row_end > imshape[0]:
+        row_end = imshape[0]
+    if col_start < 0:
+        col_start = 0
+    if col_end > imshape[1]:
+        col_end = imshape[1]
+
+    return row_start, row_end, col_start, col_end
+
+def _to_native(arr):
+    """
+    get a contiguous copy of the array in native byte order
+    """
+    dtype = arr.dtype.newbyteorder('=')
+    return np.ascontiguousarray(arr, dtype=dtype)
+
+class Packer(Processor):
+    """
+    write the preprocessed stamps for a range of FoF groups to a pack
+    file, which can be read by the Processor with --pack
+    """
+    def __init__(self, args):
+        self.args=args
+
+        self._load_conf()
+        self._check_conf()
+        self._load_meds_files()
+        self._load_fof_index()
+        self._set_fof_range()
+        self._load_fofs()
+        self._load_fof_cuts()
+
+    def go(self):
+        """
+        preprocess the requested FoF groups and write the pack
+        """
+        tm0 = time.time()
+
+        pack_writer = pack.PackWriter(
+            self.args.output,
+            self.config,
+            offsets=self.args.offsets,
+        )
+
+        for fofid in range(self.start,self.end+1):
+            if not self._is_owned(fofid):
+                logger.info('skipping %d: not owned by this tile' % fofid)
+                continue
+
+            logger.info('packing: %d:%d' % (fofid,self.end))
+            indices = self._get_fit_indices(fofid)
+            mbobs_list = self._get_fof_mbobs_list(indices)
+            pack_writer.add(fofid, indices, mbobs_list)
+
+        pack_writer.close()
+
+        tm = time.time()-tm0
+        print('total time: %g' % tm)
+
+    def _check_conf(self):
+        """
+        injection depends on the seed, so it cannot be packed
+        """
+        assert not ('inject' in self.config
+                    and self.config['inject']['do_inject']), \
+            'cannot pack with injection'
+
+_pool_processor = None
+
+def _drop_cut_nbrs(output, epochs_data, nmembers):
+    """
+    keep only the outputs for the group members, which come first
+    """
+    output = output[:nmembers]
+    if epochs_data is not None:
+        w, = np.where(np.isin(epochs_data['id'], output['id']))
+        epochs_data = epochs_data[w]
+
+    return output, epochs_data
+
+def _handle_stop_signal(signum, frame):
+    """
+    stop processing; the exception is caught in Processor.go and the
+    groups written so far are recorded in the checkpoint
+    """
+    logger.info('caught signal %d' % signum)
+    if signum == signal.SIGINT:
+        raise KeyboardInterrupt()
+    else:
+        sys.exit(128+signum)
+
+def _init_pool_processor(args):
+    """
+    make the processor used by a pool worker
+    """
+    global _pool_processor
+
+    # interruptions are handled by the parent process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    _pool_processor = Processor(args)
+
+def _process_pool_fof(fofid):
+    """
+    process a group in a pool worker
+    """
+    return fofid, _pool_processor._process_fof_timed(fofid)
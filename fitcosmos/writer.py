@@ -0,0 +1,452 @@
+"""
+incremental writing of the fitcosmos output
+"""
+import os
+import logging
+import threading
+import queue
+import numpy as np
+import fitsio
+import esutil as eu
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_DTYPE = [
+    ('fofid','i8'),
+    ('nobj','i8'),
+    ('nepoch','i8'),
+]
+
+class OutputWriter(object):
+    """
+    write the model_fits and epochs_data tables incrementally
+
+    Results are buffered and every write_every groups they are appended
+    to staged files by a background thread, so memory does not grow
+    with the size of the split.  The tables are staged in separate files,
+    because appending to a table that is not the last extension moves
+    everything after it.  On close the epochs_data are copied after the
+    model_fits in chunks and the file is renamed to the final name.
+
+    Groups can be added in any order, e.g. as they finish in a pool of
+    workers.  If they were not added in fofid order, the rows are put
+    back in fofid order on close, when copying out of the staged files,
+    so the output does not depend on the order in which the groups
+    finished.
+
+    The groups already on disk are recorded in a checkpoint file by
+    checkpoint().  When resuming, those rows are copied into new staged
+    files and the groups are listed in the completed attribute.
+
+    parameters
+    ----------
+    filename: str
+        The final output file
+    write_every: int, optional
+        Number of groups to buffer before writing, default 100
+    resume: bool, optional
+        If True, keep the groups in an existing checkpoint
+    chunksize: int, optional
+        Number of rows to copy at a time, default 100000
+    """
+    def __init__(self,
+                 filename,
+                 write_every=100,
+                 resume=False,
+                 chunksize=100000):
+
+        self.filename = filename
+        self.write_every = write_every
+        self.chunksize = chunksize
+
+        self.staged_file = filename + '.staged'
+        self.epochs_staged_file = filename + '.epochs.staged'
+        self.checkpoint_file = filename + '.checkpoint'
+
+        self.completed = set()
+
+        self._olist = []
+        self._elist = []
+        self._ilist = []
+        self._written = []
+        self._error = None
+
+        self._open_staged_files(resume)
+
+        self._queue = queue.Queue(maxsize=2)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, fofid, output, epochs_data):
+        """
+        add the results for a group.  Groups can be added in any
+        order, they are sorted by fofid on close
+        """
+        self._check_error()
+
+        index = np.zeros(1, dtype=CHECKPOINT_DTYPE)
+        index['fofid'] = fofid
+        index['nobj'] = output.size
+
+        self._olist.append(output)
+        if epochs_data is not None:
+            index['nepoch'] = epochs_data.size
+            self._elist.append(epochs_data)
+
+        self._ilist.append(index)
+
+        if len(self._ilist) >= self.write_every:
+            self._send()
+
+    def checkpoint(self):
+        """
+        write out the buffered groups and record all groups on disk
+        in the checkpoint file
+
+        The checkpoint is written under a temporary name and then
+        moved into place, so an interruption never leaves a partial
+        checkpoint
+        """
+        self._send()
+        self._queue.join()
+        self._check_error()
+
+        if len(self._written) == 0:
+            return
+
+        # the writer thread is idle, so it is safe to flush here
+        self._fits.reopen()
+        if self._efits is not None:
+            self._efits.reopen()
+
+        index = eu.numpy_util.combine_arrlist(self._written)
+        logger.info('writing checkpoint with %d groups: '
+                    '%s' % (index.size, self.checkpoint_file))
+
+        tmp_file = self.checkpoint_file + '.tmp'
+        fitsio.write(tmp_file, index, extname='checkpoint', clobber=True)
+        os.rename(tmp_file, self.checkpoint_file)
+
+    def close(self):
+        """
+        write the remaining groups, put the epochs_data after the
+        model_fits and move the file into place
+        """
+        self._send()
+        self._stop_thread()
+        self._check_error()
+
+        if len(self._written) > 0:
+            index = eu.numpy_util.combine_arrlist(self._written)
+            if np.any(np.diff(index['fofid']) < 0):
+                self._close_sorted(index)
+                return
+
+        if self._efits is not None:
+            self._efits.close()
+            self._efits = None
+            with fitsio.FITS(self.epochs_staged_file) as efits:
+                _copy_rows(
+                    efits['epochs_data'],
+                    efits['epochs_data'].get_nrows(),
+                    self._fits,
+                    'epochs_data',
+                    self.chunksize,
+                )
+
+        if 'model_fits' not in self._fits:
+            # no owned groups in the range
+            self._fits.write(None)
+
+        self._fits.close()
+
+        self._remove_checkpoint()
+        if os.path.exists(self.epochs_staged_file):
+            os.remove(self.epochs_staged_file)
+
+        logger.info('writing output: %s' % self.filename)
+        os.rename(self.staged_file, self.filename)
+
+    def _close_sorted(self, index):
+        """
+        copy the groups from the staged files in fofid order, and move
+        the result into place
+        """
+        self._fits.close()
+        if self._efits is not None:
+            self._efits.close()
+            self._efits = None
+
+        logger.info('sorting %d groups by fofid' % index.size)
+        order = index['fofid'].argsort(kind='mergesort')
+
+        sorted_file = self.filename + '.sorted'
+        with fitsio.FITS(sorted_file, 'rw', clobber=True) as fits:
+            with fitsio.FITS(self.staged_file) as sfits:
+                _copy_groups(
+                    sfits['model_fits'],
+                    index['nobj'],
+                    order,
+                    fits,
+                    'model_fits',
+                    self.chunksize,
+                )
+
+            if index['nepoch'].sum() > 0:
+                with fitsio.FITS(self.epochs_staged_file) as efits:
+                    _copy_groups(
+                        efits['epochs_data'],
+                        index['nepoch'],
+                        order,
+                        fits,
+                        'epochs_data',
+                        self.chunksize,
+                    )
+
+        self._remove_checkpoint()
+
+        _remove_files([self.staged_file, self.epochs_staged_file])
+
+        logger.info('writing output: %s' % self.filename)
+        os.rename(sorted_file, self.filename)
+
+    def _remove_checkpoint(self):
+        """
+        remove the checkpoint.  This is done before the staged files
+        are removed or moved into place, so an interruption never leaves
+        a checkpoint without its staged files
+        """
+        if os.path.exists(self.checkpoint_file):
+            logger.info('removing checkpoint: %s' % self.checkpoint_file)
+            os.remove(self.checkpoint_file)
+
+    def stop(self):
+        """
+        stop the writer thread and close the staged files without
+        moving them into place, e.g. after checkpointing on an error
+        """
+        self._stop_thread()
+
+        self._fits.close()
+        if self._efits is not None:
+            self._efits.close()
+
+    def _stop_thread(self):
+        """
+        tell the writer thread to finish and wait for it
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _send(self):
+        """
+        send the buffered groups to the writer thread
+        """
+        if len(self._ilist) == 0:
+            return
+
+        output = eu.numpy_util.combine_arrlist(self._olist)
+        if len(self._elist) > 0:
+            epochs_data = eu.numpy_util.combine_arrlist(self._elist)
+        else:
+            epochs_data = None
+        index = eu.numpy_util.combine_arrlist(self._ilist)
+
+        self._olist = []
+        self._elist = []
+        self._ilist = []
+
+        self._queue.put( (output, epochs_data, index) )
+
+    def _run(self):
+        """
+        write the batches from the queue, until None is received
+        """
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    break
+
+                if self._error is None:
+                    self._write(*item)
+
+            except Exception as err:
+                self._error = err
+            finally:
+                self._queue.task_done()
+
+    def _write(self, output, epochs_data, index):
+        """
+        append a batch to the staged files
+        """
+        logger.debug('writing %d groups' % index.size)
+        _append(self._fits, output, 'model_fits')
+
+        if epochs_data is not None:
+            if self._efits is None:
+                self._efits = fitsio.FITS(
+                    self.epochs_staged_file,
+                    'rw',
+                    clobber=True,
+                )
+            _append(self._efits, epochs_data, 'epochs_data')
+
+        self._written.append(index)
+
+    def _check_error(self):
+        """
+        raise any error from the writer thread
+        """
+        if self._error is not None:
+            raise self._error
+
+    def _open_staged_files(self, resume):
+        """
+        open new staged files, copying in the groups from the
+        checkpoint if resuming
+        """
+        old_files = None
+        if resume:
+            if os.path.exists(self.checkpoint_file):
+                old_files = self._move_staged_files()
+            else:
+                logger.info('no checkpoint found: %s' % self.checkpoint_file)
+
+        self._fits = fitsio.FITS(self.staged_file, 'rw', clobber=True)
+        self._efits = None
+
+        if old_files is not None:
+            self._copy_checkpoint(*old_files)
+
+    def _move_staged_files(self):
+        """
+        move the staged files from the interrupted run out of the way
+        """
+        old_files = []
+        for fname in [self.staged_file, self.epochs_staged_file]:
+            old_fname = fname + '.old'
+            if os.path.exists(fname):
+                os.rename(fname, old_fname)
+            old_files.append(old_fname)
+
+        return old_files
+
+    def _copy_checkpoint(self, old_file, old_epochs_file):
+        """
+        copy the rows recorded in the checkpoint from the old staged
+        files.  Rows written after the checkpoint are dropped
+        """
+        if not os.path.exists(old_file):
+            logger.info('no staged file found for the checkpoint, '
+                        'starting over: %s' % old_file)
+            _remove_files([old_epochs_file])
+            return
+
+        logger.info('loading checkpoint: %s' % self.checkpoint_file)
+        index = fitsio.read(self.checkpoint_file, ext='checkpoint')
+
+        with fitsio.FITS(old_file) as fits:
+            _copy_rows(
+                fits['model_fits'],
+                index['nobj'].sum(),
+                self._fits,
+                'model_fits',
+                self.chunksize,
+            )
+
+        nepoch = index['nepoch'].sum()
+        if nepoch > 0:
+            self._efits = fitsio.FITS(
+                self.epochs_staged_file,
+                'rw',
+                clobber=True,
+            )
+            with fitsio.FITS(old_epochs_file) as efits:
+                _copy_rows(
+                    efits['epochs_data'],
+                    nepoch,
+                    self._efits,
+                    'epochs_data',
+                    self.chunksize,
+                )
+
+        _remove_files([old_file, old_epochs_file])
+
+        self._written.append(index)
+        self.completed.update(int(fofid) for fofid in index['fofid'])
+        logger.info('found %d completed groups' % index.size)
+
+def _append(fits, data, extname):
+    """
+    append to the table, creating it if needed
+    """
+    if extname in fits:
+        fits[extname].append(data)
+    else:
+        fits.write(data, extname=extname)
+
+def _remove_files(fnames):
+    """
+    remove the files that exist
+    """
+    for fname in fnames:
+        if os.path.exists(fname):
+            os.remove(fname)
+
+def _copy_groups(hdu, counts, order, fits, extname, chunksize):
+    """
+    copy the rows of the groups from the table, with the groups in the
+    requested order
+
+    Runs of groups that are adjacent in the table are read together,
+    and the rows are appended in chunks of about chunksize rows
+
+    parameters
+    ----------
+    hdu: fitsio table HDU
+        The table to copy from, holding the groups in their original
+        order
+    counts: array
+        Number of rows for each group in the table
+    order: array
+        Indices of the groups in the order they are to be written
+    """
+    starts = np.cumsum(counts) - counts
+
+    dlist = []
+    nbuff = 0
+    i = 0
+    while i < order.size:
+        j = i+1
+        while j < order.size and order[j] == order[j-1]+1:
+            j += 1
+
+        start = starts[order[i]]
+        end = starts[order[j-1]] + counts[order[j-1]]
+
+        for cstart in range(start, end, chunksize):
+            cend = min(cstart+chunksize, end)
+            dlist.append(hdu[cstart:cend])
+            nbuff += cend-cstart
+
+            if nbuff >= chunksize:
+                _append(fits, eu.numpy_util.combine_arrlist(dlist), extname)
+                dlist = []
+                nbuff = 0
+
+        i = j
+
+    if len(dlist) > 0:
+        _append(fits, eu.numpy_util.combine_arrlist(dlist), extname)
+
+def _copy_rows(hdu, nrows, fits, extname, chunksize):
+    """
+    copy the first nrows of the table into the file, in chunks
+    """
+    for start in range(0, nrows, chunksize):
+        end = min(start+chunksize, nrows)
+        data = hdu[start:end]
+        _append(fits, data, extname)